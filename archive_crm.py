@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Move conversations and closed bookings older than N days (default 90)
+into monthly gzip archive segments next to the CRM data.
+Nothing is deleted: archived records stay queryable via crm.query_archive().
+
+Usage: python3 archive_crm.py [days]
+"""
+import sys
+
+from dotenv import load_dotenv
+
+from simple_crm import ARCHIVE_AFTER_DAYS, create_crm
+
+def main():
+    load_dotenv()
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    # Goes through the CRM service when CRM_SOCKET is set, so the running bot keeps its data consistent
+    crm = create_crm()
+    try:
+        moved = crm.archive(days)
+    finally:
+        crm.close()
+    print(f"✅ Archived older than {days} days. Conversations: {moved['conversations']}, Bookings: {moved['bookings']}, "
+          f"old change events trimmed: {moved.get('changes', 0)}")
+
+if __name__ == "__main__":
+    main()
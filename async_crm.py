@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Асинхронная обёртка CRM для обработчиков ботов.
+
+Изменения выполняются в отдельном потоке записи (строго по очереди),
+чтение SimpleCRM идёт прямо из памяти. Цикл событий бота не ждёт диска.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from simple_crm import LAZY_COLLECTIONS, SimpleCRM
+
+# Методы, которые меняют данные или обращаются к диску — выполняются в потоке записи
+WRITE_METHODS = {
+    "add_user", "update_user_activity", "update_user", "delete_user",
+    "add_conversation",
+    "add_booking", "update_booking", "update_booking_status", "delete_booking",
+    "add_course", "update_course", "delete_course",
+    "add_teacher", "update_teacher", "delete_teacher",
+    "add_employee", "update_employee", "delete_employee",
+    "set_ai_system_prompt", "reload", "flush", "archive",
+}
+
+# Чтение, которое SimpleCRM отдаёт из памяти
+READ_METHODS = {
+    "get_user", "get_user_by_id", "get_all_users", "get_users_by_activity", "query_users",
+    "get_user_metrics", "get_users_metrics", "get_all_user_metrics",
+    "get_recent_conversations", "get_user_conversations", "get_all_conversations",
+    "get_booking", "get_recent_bookings", "query_bookings", "get_user_bookings", "get_all_bookings",
+    "get_courses", "get_course", "get_all_courses",
+    "get_teachers", "get_teacher", "get_all_teachers",
+    "get_all_employees", "get_employee_by_username", "get_records_chunk",
+    "get_statistics", "get_ai_system_prompt",
+    "query_archive", "read_changes", "last_change_seq",
+}
+
+# Чтение, которое даже у SimpleCRM обращается к диску (reload(), журналы, архив) или ждёт
+# блокировки хранилища, пока поток записи сбрасывает данные или меняет индексы активности
+# и буферы последних диалогов, — в обёртке всегда уходит в пул потоков
+DISK_READ_METHODS = {
+    "get_statistics", "get_ai_system_prompt", "query_users", "query_bookings", "get_records_chunk",
+    "query_archive", "read_changes", "last_change_seq",
+    "get_users_by_activity", "get_recent_conversations", "get_user_conversations",
+}
+
+
+class AsyncSimpleCRM:
+    """CRM с awaitable-методами: await crm.add_user(...), await crm.get_user(...)"""
+
+    def __init__(self, crm):
+        self.crm = crm
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="crm-writer")
+        # SimpleCRM держит всё в памяти; у SQLite и сервиса CRM чтение — это запрос
+        self._reads_in_memory = isinstance(crm, SimpleCRM)
+        if self._reads_in_memory:
+            # Ленивые коллекции читаем сразу, а не при первом сообщении в цикле событий
+            for collection in LAZY_COLLECTIONS:
+                crm._require(collection)
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнить func в потоке записи (например, несколько изменений в crm.transaction())"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(func, *args, **kwargs))
+
+    async def _read(self, method: str, *args, **kwargs):
+        func = getattr(self.crm, method)
+        if self._reads_in_memory and method not in DISK_READ_METHODS:
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name: str):
+        if name in WRITE_METHODS:
+            return functools.partial(self.run, getattr(self.crm, name))
+        if name in READ_METHODS:
+            return functools.partial(self._read, name)
+        raise AttributeError(name)
+
+    def close(self):
+        """Дождаться очереди записи и сбросить данные на диск (после остановки цикла событий)"""
+        self._writer.shutdown(wait=True)
+        self.crm.close()
@@ -5,37 +5,122 @@ Keeps courses, teachers, schedule, analytics.
 Creates backup: crm_data.backup.all.json
 """
 import json
+import os
+import socket
 from pathlib import Path
 
+from simple_crm import TEXT_STORE_FIELDS, atomic_write_text, locked_file
+
 CRM_PATH = Path("crm_data.json")
+CONVERSATIONS_LOG = Path("crm_data.conversations.jsonl")
+# the same sidecar lock SimpleCRM takes while appending to or compacting the log
+CONVERSATIONS_LOCK = Path("crm_data.conversations.lock")
+# long message texts, referenced from the log as message_ref/response_ref
+TEXTS_LOG = Path("crm_data.texts.jsonl")
+# users and bookings live in their own files: {"sequence": <last id>, "records": [...]}
+COLLECTION_FILES = {
+    "users": Path("crm_data.users.json"),
+    "bookings": Path("crm_data.bookings.json"),
+}
 BACKUP_PATH = Path("crm_data.backup.all.json")
 
+def read_collections(data: dict) -> dict:
+    """Pull split collection files into data; returns their id sequences"""
+    sequences = {}
+    for name, path in COLLECTION_FILES.items():
+        if path.exists():
+            content = json.loads(path.read_text(encoding="utf-8"))
+            data[name] = content.get("records", [])
+            sequences[name] = content.get("sequence", 0)
+    return sequences
+
+def write_collections(data: dict, sequences: dict):
+    for name, path in COLLECTION_FILES.items():
+        content = {"sequence": sequences.get(name, data.get("sequences", {}).get(name, 0)), "records": data.pop(name, [])}
+        atomic_write_text(str(path), json.dumps(content, ensure_ascii=False, indent=2))
+
+def max_conversation_id(data: dict) -> int:
+    """Highest conversation id: the stored sequence or the largest id in the log, whichever is bigger"""
+    ids = [c.get("id") for c in data.get("conversations", []) if isinstance(c.get("id"), int)]
+    return max([data.get("sequences", {}).get("conversations", 0), *ids])
+
+def read_texts() -> dict:
+    """Long texts by digest from the texts table"""
+    texts = {}
+    if TEXTS_LOG.exists():
+        for line in TEXTS_LOG.read_text(encoding="utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            texts.setdefault(entry["h"], entry["t"])
+    return texts
+
+def with_texts(conversations: list) -> list:
+    """Copies of conversations with *_ref digests replaced by the full text (for a self-contained backup)"""
+    texts = read_texts()
+    resolved = []
+    for c in conversations:
+        c = dict(c)
+        for field in TEXT_STORE_FIELDS:
+            digest = c.pop(f"{field}_ref", None)
+            if digest is not None:
+                c[field] = texts.get(digest, "")
+        resolved.append(c)
+    return resolved
+
+def service_running() -> bool:
+    """True if the CRM service answers on its socket (it keeps the data in memory and would overwrite us)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.getenv("CRM_SOCKET", "crm.sock"))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
 def main():
     if not CRM_PATH.exists():
         print("❌ crm_data.json not found")
         return
+    if service_running():
+        print("❌ CRM service is running — stop it first (it holds the data in memory)")
+        return
+
+    # appends and archive() wait until the log and the data files are rewritten
+    with locked_file(str(CONVERSATIONS_LOCK)):
+        data = json.loads(CRM_PATH.read_text(encoding="utf-8"))
+        sequences = read_collections(data)
+        # conversations live in the append-only log next to the snapshot
+        if CONVERSATIONS_LOG.exists():
+            for line in CONVERSATIONS_LOG.read_text(encoding="utf-8").splitlines():
+                try:
+                    data.setdefault("conversations", []).append(json.loads(line))
+                except ValueError:
+                    continue
 
-    data = json.loads(CRM_PATH.read_text(encoding="utf-8"))
+        # the log runs ahead of the stored conversation counter — keep the highest id seen,
+        # so wiped ids are never handed out again
+        data.setdefault("sequences", {})["conversations"] = max_conversation_id(data)
 
-    # backup
-    BACKUP_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        # backup
+        backup = dict(data, conversations=with_texts(data.get("conversations", [])))
+        BACKUP_PATH.write_text(json.dumps(backup, ensure_ascii=False, indent=2), encoding="utf-8")
 
-    # wipe dynamic sets
-    data["users"] = []
-    data["bookings"] = []
-    data["conversations"] = []
+        # wipe dynamic sets
+        data["users"] = []
+        data["bookings"] = []
+        data.pop("conversations", None)
 
-    # reset statistics
-    stats = data.get("statistics", {})
-    stats["total_users"] = 0
-    stats["total_conversations"] = 0
-    stats["total_bookings"] = 0
-    # Keep active courses/teachers as-is if present
-    data["statistics"] = stats
+        # statistics are recomputed by SimpleCRM on load
+        data.pop("statistics", None)
 
-    # persist
-    CRM_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    print("✅ All dynamic CRM data wiped (users, bookings, conversations). Backup saved to", BACKUP_PATH.name)
+        # persist (ids keep counting from the sequences saved above, so wiped ids are not reused)
+        write_collections(data, sequences)
+        atomic_write_text(str(CRM_PATH), json.dumps(data, ensure_ascii=False, indent=2))
+        atomic_write_text(str(CONVERSATIONS_LOG), "")
+        print("✅ All dynamic CRM data wiped (users, bookings, conversations). Backup saved to", BACKUP_PATH.name)
 
 if __name__ == "__main__":
     main()
@@ -4,10 +4,24 @@ Cleanup CRM: keep only today's users, bookings, and conversations.
 Makes a backup: crm_data.backup.json
 """
 import json
+import os
+import socket
 from datetime import datetime
 from pathlib import Path
 
+from simple_crm import TEXT_STORE_FIELDS, atomic_write_text, locked_file
+
 CRM_PATH = Path("crm_data.json")
+CONVERSATIONS_LOG = Path("crm_data.conversations.jsonl")
+# the same sidecar lock SimpleCRM takes while appending to or compacting the log
+CONVERSATIONS_LOCK = Path("crm_data.conversations.lock")
+# long message texts, referenced from the log as message_ref/response_ref
+TEXTS_LOG = Path("crm_data.texts.jsonl")
+# users and bookings live in their own files: {"sequence": <last id>, "records": [...]}
+COLLECTION_FILES = {
+    "users": Path("crm_data.users.json"),
+    "bookings": Path("crm_data.bookings.json"),
+}
 BACKUP_PATH = Path("crm_data.backup.json")
 
 def iso_date(dt_str: str) -> str:
@@ -16,58 +30,142 @@ def iso_date(dt_str: str) -> str:
     # Accept either ISO datetime or date
     return dt_str[:10]
 
+def read_conversations_log() -> list:
+    if not CONVERSATIONS_LOG.exists():
+        return []
+    conversations = []
+    for line in CONVERSATIONS_LOG.read_text(encoding="utf-8").splitlines():
+        try:
+            conversations.append(json.loads(line))
+        except ValueError:
+            continue
+    return conversations
+
+def write_conversations_log(conversations: list):
+    lines = "".join(json.dumps(c, ensure_ascii=False) + "\n" for c in conversations)
+    atomic_write_text(str(CONVERSATIONS_LOG), lines)
+
+def read_collections(data: dict) -> dict:
+    """Pull split collection files into data; returns their id sequences"""
+    sequences = {}
+    for name, path in COLLECTION_FILES.items():
+        if path.exists():
+            content = json.loads(path.read_text(encoding="utf-8"))
+            data[name] = content.get("records", [])
+            sequences[name] = content.get("sequence", 0)
+    return sequences
+
+def write_collections(data: dict, sequences: dict):
+    for name, path in COLLECTION_FILES.items():
+        content = {"sequence": sequences.get(name, data.get("sequences", {}).get(name, 0)), "records": data.pop(name, [])}
+        atomic_write_text(str(path), json.dumps(content, ensure_ascii=False, indent=2))
+
+def max_conversation_id(data: dict) -> int:
+    """Highest conversation id: the stored sequence or the largest id in the log, whichever is bigger"""
+    ids = [c.get("id") for c in data.get("conversations", []) if isinstance(c.get("id"), int)]
+    return max([data.get("sequences", {}).get("conversations", 0), *ids])
+
+def read_texts() -> dict:
+    """Long texts by digest from the texts table"""
+    texts = {}
+    if TEXTS_LOG.exists():
+        for line in TEXTS_LOG.read_text(encoding="utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            texts.setdefault(entry["h"], entry["t"])
+    return texts
+
+def with_texts(conversations: list) -> list:
+    """Copies of conversations with *_ref digests replaced by the full text (for a self-contained backup)"""
+    texts = read_texts()
+    resolved = []
+    for c in conversations:
+        c = dict(c)
+        for field in TEXT_STORE_FIELDS:
+            digest = c.pop(f"{field}_ref", None)
+            if digest is not None:
+                c[field] = texts.get(digest, "")
+        resolved.append(c)
+    return resolved
+
+def service_running() -> bool:
+    """True if the CRM service answers on its socket (it keeps the data in memory and would overwrite us)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.getenv("CRM_SOCKET", "crm.sock"))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
 def main():
     today = datetime.now().date().isoformat()
     if not CRM_PATH.exists():
         print("❌ crm_data.json not found")
         return
-    data = json.loads(CRM_PATH.read_text(encoding="utf-8"))
-
-    # Backup
-    BACKUP_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-
-    # Filter users by first_contact_date == today
-    users = data.get("users", [])
-    users_today = []
-    keep_telegram_ids = set()
-    for u in users:
-        fcd = u.get("first_contact_date")
-        if fcd and fcd == today:
-            users_today.append(u)
-            tid = u.get("telegram_id")
-            if tid is not None:
-                keep_telegram_ids.add(tid)
-
-    # Filter conversations for today OR belonging to kept users and created today
-    conversations = data.get("conversations", [])
-    conversations_today = []
-    for c in conversations:
-        if iso_date(c.get("created_at")) == today:
-            # additionally ensure user is kept if we filtered users by today
-            if not keep_telegram_ids or c.get("telegram_id") in keep_telegram_ids:
-                conversations_today.append(c)
-
-    # Filter bookings created today OR user_id in kept users and created today
-    bookings = data.get("bookings", [])
-    bookings_today = []
-    for b in bookings:
-        if iso_date(b.get("created_at")) == today:
-            if not keep_telegram_ids or b.get("user_id") in keep_telegram_ids:
-                bookings_today.append(b)
-
-    data["users"] = users_today
-    data["conversations"] = conversations_today
-    data["bookings"] = bookings_today
-
-    # Update statistics
-    stats = data.get("statistics", {})
-    stats["total_users"] = len(users_today)
-    stats["total_conversations"] = len(conversations_today)
-    stats["total_bookings"] = len(bookings_today)
-    data["statistics"] = stats
-
-    CRM_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"✅ Cleaned. Users: {len(users_today)}, Conversations: {len(conversations_today)}, Bookings: {len(bookings_today)}")
+    if service_running():
+        print("❌ CRM service is running — stop it first (it holds the data in memory)")
+        return
+    # appends and archive() wait until the log and the data files are rewritten
+    with locked_file(str(CONVERSATIONS_LOCK)):
+        data = json.loads(CRM_PATH.read_text(encoding="utf-8"))
+        sequences = read_collections(data)
+        # Conversations live in the append-only log; merge legacy ones from the snapshot
+        logged = read_conversations_log()
+        logged_keys = {(c.get("id"), c.get("created_at")) for c in logged}
+        legacy = [c for c in data.get("conversations", []) if (c.get("id"), c.get("created_at")) not in logged_keys]
+        data["conversations"] = legacy + logged
+        # the log runs ahead of the stored conversation counter — keep the highest id seen,
+        # so removed ids are never handed out again
+        data.setdefault("sequences", {})["conversations"] = max_conversation_id(data)
+
+        # Backup
+        backup = dict(data, conversations=with_texts(data.get("conversations", [])))
+        BACKUP_PATH.write_text(json.dumps(backup, ensure_ascii=False, indent=2), encoding="utf-8")
+
+        # Filter users by first_contact_date == today
+        users = data.get("users", [])
+        users_today = []
+        keep_telegram_ids = set()
+        for u in users:
+            fcd = u.get("first_contact_date")
+            if fcd and fcd == today:
+                users_today.append(u)
+                tid = u.get("telegram_id")
+                if tid is not None:
+                    keep_telegram_ids.add(tid)
+
+        # Filter conversations for today OR belonging to kept users and created today
+        conversations = data.get("conversations", [])
+        conversations_today = []
+        for c in conversations:
+            if iso_date(c.get("created_at")) == today:
+                # additionally ensure user is kept if we filtered users by today
+                if not keep_telegram_ids or c.get("telegram_id") in keep_telegram_ids:
+                    conversations_today.append(c)
+
+        # Filter bookings created today OR user_id in kept users and created today
+        bookings = data.get("bookings", [])
+        bookings_today = []
+        for b in bookings:
+            if iso_date(b.get("created_at")) == today:
+                if not keep_telegram_ids or b.get("user_id") in keep_telegram_ids:
+                    bookings_today.append(b)
+
+        data["users"] = users_today
+        data["bookings"] = bookings_today
+        data.pop("conversations", None)
+
+        # Statistics are recomputed by SimpleCRM on load
+        data.pop("statistics", None)
+
+        write_collections(data, sequences)
+        atomic_write_text(str(CRM_PATH), json.dumps(data, ensure_ascii=False, indent=2))
+        write_conversations_log(conversations_today)
+        print(f"✅ Cleaned. Users: {len(users_today)}, Conversations: {len(conversations_today)}, Bookings: {len(bookings_today)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Компактные записи CRM: поля в __slots__, время — целые микросекунды эпохи,
+статусы — перечисления.
+
+Записи ведут себя как словари (get, [], keys, dict(record)), поэтому бот,
+панель и шаблоны работают с ними как раньше. В обычные словари записи
+превращаются только на границах: при записи на диск и при отправке по сокету.
+"""
+
+import functools
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+
+class StatusEnum(str, Enum):
+    """Статус, который в шаблонах и f-строках выглядит как обычная строка"""
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+class BookingStatus(StatusEnum):
+    PENDING = "pending"
+    CONFIRMED = "confirmed"
+    CANCELLED = "cancelled"
+    NEW = "new"
+    CALL_SUCCESS = "call_success"
+    CALL_FAILED = "call_failed"
+    CALLBACK = "callback"
+    TRIAL_BOOKING = "trial_booking"
+    ONLINE_TRIAL_BOOKING = "online_trial_booking"
+    TRIAL_COMPLETED = "trial_completed"
+    PREPAYMENT = "prepayment"
+    WAITING_GROUP = "waiting_group"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+
+class UserStatus(StatusEnum):
+    ACTIVE = "active"
+    NEW = "new"
+    CALL_SUCCESS = "call_success"
+    CALL_FAILED = "call_failed"
+    CALLBACK = "callback"
+    TRIAL_BOOKING = "trial_booking"
+    ONLINE_TRIAL_BOOKING = "online_trial_booking"
+    TRIAL_COMPLETED = "trial_completed"
+    PREPAYMENT = "prepayment"
+    WAITING_GROUP = "waiting_group"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+
+# Время хранится без часового пояса, как и в строках datetime.now().isoformat()
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+def now_ts() -> int:
+    """Текущее время в микросекундах эпохи"""
+    return (datetime.now() - EPOCH) // MICROSECOND
+
+def ts_from_datetime(dt: datetime) -> int:
+    return (dt.replace(tzinfo=None) - EPOCH) // MICROSECOND
+
+@functools.lru_cache(maxsize=16384)
+def format_ts(ts: int) -> str:
+    # Строку времени читают сортировки и циклы шаблонов — одни и те же записи форматируются один раз
+    return (EPOCH + timedelta(microseconds=ts)).isoformat()
+
+def parse_ts(value) -> Optional[int]:
+    """ISO-строка -> микросекунды эпохи (None, если это не дата)"""
+    if not isinstance(value, str):
+        return None
+    try:
+        return ts_from_datetime(datetime.fromisoformat(value))
+    except ValueError:
+        return None
+
+def sort_ts(record, key: str) -> int:
+    """Время поля для сортировки: у записи — число из слота без форматирования, у словаря — разобранная строка"""
+    if isinstance(record, Record):
+        return record.timestamp(key)
+    return parse_ts(record.get(key)) or 0
+
+
+# Часовой пояс панели — один объект на процесс, а не новый на каждую дату
+TASHKENT = ZoneInfo("Asia/Tashkent")
+
+def format_tashkent_datetime(dt_str: str) -> str:
+    """ISO-время -> "ДД.ММ.ГГГГ ЧЧ:ММ" по Ташкенту"""
+    try:
+        if not dt_str:
+            return "—"
+        dt = datetime.fromisoformat(dt_str)
+        # Если без таймзоны — считаем, что это время Ташкента
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=TASHKENT)
+        else:
+            dt = dt.astimezone(TASHKENT)
+        return dt.strftime("%d.%m.%Y %H:%M")
+    except Exception:
+        return dt_str or "—"
+
+
+# Столбцы Канбан-воронки и старые статусы, которые в них попадают
+KANBAN_STATUSES = {
+    "new", "call_success", "call_failed", "callback",
+    "trial_booking", "online_trial_booking", "trial_completed",
+    "prepayment", "waiting_group", "success", "failed",
+}
+
+USER_STATUS_ALIASES = {
+    "active": "call_success",
+    "converted": "success",
+    "pending": "new",
+    "inactive": "failed",
+    "won": "success",
+    "lost": "failed",
+    "in_progress": "call_success",
+}
+
+BOOKING_STATUS_ALIASES = {
+    # Из прежнего списка таблицы
+    "pending": "new",
+    "confirmed": "success",
+    "cancelled": "failed",
+    # Возможные другие синонимы
+    "in_progress": "call_success",
+    "won": "success",
+    "lost": "failed",
+    "active": "call_success",
+    "inactive": "failed",
+}
+
+def normalize_user_status(raw_status: str) -> str:
+    """Нормализуем статус пользователя к расширенной воронке Канбан"""
+    if not raw_status:
+        return "new"
+    s = str(raw_status).strip().lower()
+    if s in KANBAN_STATUSES:
+        return s
+    return USER_STATUS_ALIASES.get(s, "new")
+
+def normalize_booking_status(raw_status: str) -> str:
+    """Приводит различные статусы бронирований к единому набору Канбан"""
+    if not raw_status:
+        return "new"
+    s = str(raw_status).strip().lower()
+    if s in KANBAN_STATUSES or s == "all":
+        return s
+    return BOOKING_STATUS_ALIASES.get(s, "new")
+
+def split_languages(raw_languages) -> Optional[List[str]]:
+    """Языки преподавателя списком (в старых данных — строка через запятую)"""
+    if isinstance(raw_languages, str):
+        return [lng.strip() for lng in raw_languages.split(",") if lng.strip()]
+    return raw_languages
+
+def teacher_experience_years(teacher) -> Optional[int]:
+    """Опыт в годах: явный experience_years, иначе по году created_at"""
+    try:
+        if teacher.get("experience_years") is not None:
+            return int(teacher.get("experience_years"))
+    except (TypeError, ValueError):
+        pass
+    created_at = teacher.get("created_at")
+    if not created_at:
+        return None
+    try:
+        return max(0, datetime.now().year - datetime.fromisoformat(created_at).year)
+    except (TypeError, ValueError):
+        return None
+
+# Версия производных полей: при её росте записи, сохранённые со старой версией, пересчитываются при загрузке
+DISPLAY_FIELDS_VERSION = 2
+
+def display_fields(collection: str, record) -> Dict:
+    """Поля для отображения, которые выводятся из остальных полей записи"""
+    if collection == "users":
+        return {"kanban_status": normalize_user_status(record.get("status"))}
+    if collection == "bookings":
+        return {
+            "kanban_status": normalize_booking_status(record.get("status")),
+            "created_at_fmt": format_tashkent_datetime(record.get("created_at")),
+            "updated_at_fmt": format_tashkent_datetime(record.get("updated_at")),
+        }
+    if collection == "teachers":
+        fields = {"experience_years_display": teacher_experience_years(record)}
+        if isinstance(record.get("languages"), str):
+            fields["languages"] = split_languages(record["languages"])
+        return fields
+    return {}
+
+def materialize(collection: str, record) -> bool:
+    """Сохранить производные поля в записи (при записи и загрузке старых данных); True, если что-то изменилось"""
+    changed = False
+    for key, value in display_fields(collection, record).items():
+        if key not in record or record[key] != value:
+            record[key] = value
+            changed = True
+    return changed
+
+
+_MISSING = object()
+
+
+def _slots(fields, timestamps) -> tuple:
+    """Имена слотов: поле хранится в "_<поле>", время — в "<поле>_ts".
+
+    Атрибут с именем самого поля не существует, поэтому шаблоны Jinja
+    (record.field) читают значение через record["field"], как у словаря.
+    """
+    return tuple("_" + field for field in fields) + tuple(key + "_ts" for key in timestamps)
+
+
+class Record(MutableMapping):
+    """Запись CRM со словарным интерфейсом.
+
+    FIELDS — поля в слотах, TIMESTAMPS — поля времени (в слоте <поле>_ts),
+    ENUMS — поля-перечисления. Остальные ключи попадают в extra.
+    Отсутствующее поле и поле со значением None различаются, как в словаре.
+    """
+    __slots__ = ("extra",)
+    FIELDS = ()
+    TIMESTAMPS = ()
+    ENUMS: Dict[str, type] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Для атрибутного доступа (шаблоны Jinja) время отдаётся строкой ISO
+        for key in cls.TIMESTAMPS:
+            setattr(cls, key, property(lambda self, key=key: self.get(key)))
+
+    def __init__(self, data: Optional[Dict] = None):
+        self.extra = None
+        for field in self.FIELDS:
+            setattr(self, "_" + field, _MISSING)
+        for key in self.TIMESTAMPS:
+            setattr(self, key + "_ts", _MISSING)
+        if data:
+            for key, value in data.items():
+                self[key] = value
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Record":
+        return data if isinstance(data, cls) else cls(data)
+
+    def to_dict(self) -> Dict:
+        return dict(self.items())
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        if key in self.TIMESTAMPS:
+            ts = getattr(self, key + "_ts")
+            if ts is _MISSING:
+                raise KeyError(key)
+            return None if ts is None else format_ts(ts)
+        if key in self.FIELDS:
+            value = getattr(self, "_" + key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value.value if isinstance(value, Enum) else value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if self.extra is not None:
+            self.extra.pop(key, None)
+        if key in self.TIMESTAMPS:
+            ts = parse_ts(value)
+            if value is not None and (ts is None or format_ts(ts) != value):
+                # Нестандартную строку (дата без времени, часовой пояс) отдаём как была;
+                # в слоте остаётся разобранное время для сортировки
+                self._set_extra(key, value)
+            setattr(self, key + "_ts", ts)
+        elif key in self.FIELDS:
+            enum = self.ENUMS.get(key)
+            if enum is not None and isinstance(value, str):
+                try:
+                    value = enum(value)
+                except ValueError:
+                    pass
+            setattr(self, "_" + key, value)
+        else:
+            self._set_extra(key, value)
+
+    def _set_extra(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self.extra is not None and key in self.extra:
+            del self.extra[key]
+            if key not in self.TIMESTAMPS:
+                return
+        if key in self.TIMESTAMPS:
+            setattr(self, key + "_ts", _MISSING)
+        else:
+            setattr(self, "_" + key, _MISSING)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, "_" + field) is not _MISSING:
+                yield field
+        for key in self.TIMESTAMPS:
+            if getattr(self, key + "_ts") is not _MISSING and not (self.extra and key in self.extra):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def set_timestamp(self, key: str, ts: Optional[int]):
+        """Записать время без разбора строки"""
+        if self.extra is not None:
+            self.extra.pop(key, None)
+        setattr(self, key + "_ts", ts)
+
+    def timestamp(self, key: str) -> int:
+        """Время поля для сортировки и сравнения (0, если его нет)"""
+        ts = getattr(self, key + "_ts")
+        return 0 if ts is _MISSING or ts is None else ts
+
+    def copy(self) -> Dict:
+        return self.to_dict()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class User(Record):
+    FIELDS = (
+        "id", "telegram_id", "username", "first_name", "last_name", "phone", "instagram_username",
+        "level", "source", "status", "first_contact_date", "first_call_response", "first_call_date",
+        "second_contact_response", "second_contact_date", "decision", "decision_date", "result",
+        "is_active", "preferred_language",
+        # Производные поля (crm_models.materialize)
+        "kanban_status",
+    )
+    TIMESTAMPS = ("created_at", "last_activity", "updated_at")
+    ENUMS = {"status": UserStatus}
+    __slots__ = _slots(FIELDS, TIMESTAMPS)
+
+
+class Booking(Record):
+    FIELDS = (
+        "id", "user_id", "user_name", "user_phone", "course_id", "course_name",
+        "teacher_id", "teacher_name", "status", "notes",
+        # Производные поля (crm_models.materialize)
+        "kanban_status", "created_at_fmt", "updated_at_fmt",
+    )
+    TIMESTAMPS = ("created_at", "updated_at")
+    ENUMS = {"status": BookingStatus}
+    __slots__ = _slots(FIELDS, TIMESTAMPS)
+
+
+class Conversation(Record):
+    FIELDS = ("id", "telegram_id", "message", "response")
+    TIMESTAMPS = ("created_at",)
+    __slots__ = _slots(FIELDS, TIMESTAMPS)
+
+
+class Course(Record):
+    FIELDS = (
+        "id", "name", "description", "duration", "price", "level", "days",
+        "time_from", "time_to", "teacher_id", "teacher_name", "is_active",
+    )
+    TIMESTAMPS = ("created_at", "updated_at")
+    __slots__ = _slots(FIELDS, TIMESTAMPS)
+
+
+class Teacher(Record):
+    FIELDS = (
+        "id", "name", "specialization", "experience", "experience_years", "languages",
+        "phone", "email", "is_active",
+        # Производное поле (crm_models.materialize)
+        "experience_years_display",
+    )
+    TIMESTAMPS = ("created_at", "updated_at")
+    __slots__ = _slots(FIELDS, TIMESTAMPS)
+
+
+class Employee(Record):
+    FIELDS = (
+        "id", "name", "role", "username", "password_hash", "email", "phone", "permissions", "is_active",
+    )
+    TIMESTAMPS = ("created_at", "updated_at", "last_login")
+    __slots__ = _slots(FIELDS, TIMESTAMPS)
+
+
+# Класс записи для каждой коллекции
+MODELS = {
+    "users": User,
+    "bookings": Booking,
+    "conversations": Conversation,
+    "courses": Course,
+    "teachers": Teacher,
+    "employees": Employee,
+}
+
+def to_plain(obj):
+    """default= для json.dumps и msgpack: запись -> обычный словарь"""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Локальный сервис CRM: один процесс владеет данными и обслуживает бота,
+веб-панель и ассистентов через Unix-сокет.
+
+Запуск: python3 crm_server.py [путь_к_сокету]
+Клиенты подключаются через create_crm(), если задана переменная CRM_SOCKET.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    import msgpack
+except ImportError:  # msgpack необязателен — без него используется JSON
+    msgpack = None
+
+from crm_models import to_plain
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "crm.sock"
+
+# Методы SimpleCRM, доступные через сокет
+REMOTE_METHODS = {
+    "add_user", "get_user", "get_user_by_id", "update_user_activity", "update_user", "delete_user",
+    "get_all_users", "get_users_by_activity", "query_users", "get_user_metrics", "get_users_metrics",
+    "get_all_user_metrics",
+    "add_conversation", "get_recent_conversations", "get_user_conversations", "get_all_conversations",
+    "add_booking", "get_booking", "update_booking", "update_booking_status", "delete_booking",
+    "get_recent_bookings", "query_bookings", "get_user_bookings", "get_all_bookings",
+    "get_courses", "get_course", "add_course", "update_course", "delete_course", "get_all_courses",
+    "get_teachers", "get_teacher", "add_teacher", "update_teacher", "delete_teacher", "get_all_teachers",
+    "get_all_employees", "get_employee_by_username", "add_employee", "update_employee", "delete_employee",
+    "get_statistics", "get_ai_system_prompt", "set_ai_system_prompt", "reload", "flush",
+    "get_records_chunk", "archive", "query_archive", "read_changes", "last_change_seq",
+}
+
+# Чтение: если ответ потерян, вызов можно повторить без риска задвоить данные
+RETRYABLE_METHODS = {method for method in REMOTE_METHODS if method.startswith(("get_", "query_", "read_", "last_"))}
+
+# Транзакции: между begin и commit/rollback вызовы других клиентов ждут
+TRANSACTION_METHODS = {"begin", "commit", "rollback"}
+
+# Кадр: 1 байт кодека (b"m" — msgpack, b"j" — JSON) + 4 байта длины + тело
+HEADER = struct.Struct(">cI")
+
+
+def encode(codec: bytes, obj) -> bytes:
+    if codec == b"m":
+        body = msgpack.packb(obj, use_bin_type=True, default=to_plain)
+    else:
+        body = json.dumps(obj, ensure_ascii=False, default=to_plain).encode("utf-8")
+    return HEADER.pack(codec, len(body)) + body
+
+
+def decode(codec: bytes, body: bytes):
+    if codec == b"m":
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    return json.loads(body)
+
+
+class CRMRemoteError(Exception):
+    """Ошибка, возникшая при выполнении метода в сервисе CRM"""
+
+
+# Стандартные исключения сервиса поднимаются у клиента с тем же типом: except ValueError
+# в панели срабатывает и при работе через сервис. Они же — подклассы CRMRemoteError
+REMOTE_EXCEPTIONS = {
+    cls.__name__: type(cls.__name__, (CRMRemoteError, cls), {"__module__": __name__})
+    for cls in (ValueError, TypeError, KeyError, IndexError, LookupError, AttributeError,
+                RuntimeError, PermissionError, FileNotFoundError, OSError)
+}
+
+
+class CRMServer:
+    def __init__(self, crm, socket_path: str = DEFAULT_SOCKET):
+        self.crm = crm
+        self.socket_path = socket_path
+        # Клиент с открытой транзакцией и глубина её вложенности
+        self._tx_owner = None
+        self._tx_depth = 0
+        self._tx_done = asyncio.Event()
+        self._tx_done.set()
+
+    def dispatch(self, request: dict) -> dict:
+        """Выполнить один вызов. Всё выполняется в цикле событий — вызовы идут строго по очереди"""
+        method = request.get("m")
+        if method not in REMOTE_METHODS and method not in TRANSACTION_METHODS:
+            return {"e": f"Метод недоступен: {method}", "t": "AttributeError"}
+        try:
+            result = getattr(self.crm, method)(*request.get("a", []), **request.get("k", {}))
+        except Exception as e:
+            logger.exception(f"Ошибка при выполнении {method}")
+            return {"e": str(e), "t": type(e).__name__}
+        return {"r": result}
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    codec, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                    body = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    break
+                if codec == b"m" and msgpack is None:
+                    # Клиент с msgpack, сервер без него — отвечаем ошибкой в JSON
+                    writer.write(encode(b"j", {"e": "msgpack не установлен на сервере", "t": "RuntimeError"}))
+                else:
+                    request = decode(codec, body)
+                    # Чужие вызовы не перемежаются с вызовами открытой транзакции
+                    while self._tx_owner is not None and self._tx_owner is not writer:
+                        await self._tx_done.wait()
+                    method = request.get("m")
+                    if method in ("commit", "rollback") and self._tx_owner is not writer:
+                        response = {"e": "Транзакция не начата", "t": "RuntimeError"}
+                    else:
+                        response = self.dispatch(request)
+                        # commit/rollback завершают уровень транзакции даже при ошибке
+                        if method in ("commit", "rollback") or (method == "begin" and "e" not in response):
+                            self._track_transaction(writer, method)
+                    writer.write(encode(codec, response))
+                await writer.drain()
+        finally:
+            # Клиент отключился посреди транзакции — его изменения отменяются
+            while self._tx_owner is writer:
+                self.crm.rollback()
+                self._track_transaction(writer, "rollback")
+            writer.close()
+
+    def _track_transaction(self, writer: asyncio.StreamWriter, method: str):
+        if method == "begin":
+            self._tx_owner = writer
+            self._tx_depth += 1
+            self._tx_done.clear()
+        elif method in ("commit", "rollback"):
+            self._tx_depth -= 1
+            if not self._tx_depth:
+                self._tx_owner = None
+                self._tx_done.set()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        logger.info(f"Сервис CRM слушает {self.socket_path}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        async with server:
+            await stop.wait()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class RemoteCRM:
+    """Клиент сервиса CRM с тем же интерфейсом, что и SimpleCRM"""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.codec = b"m" if msgpack is not None else b"j"
+        self._lock = threading.Lock()
+        self._sock = None
+        self._tx_depth = 0
+        self._connect()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _recv_exactly(self, size: int) -> bytes:
+        chunks = []
+        while size:
+            chunk = self._sock.recv(size)
+            if not chunk:
+                raise ConnectionError("Сервис CRM закрыл соединение")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _send(self, frame: bytes):
+        """Отправить кадр; если соединение оборвалось, переподключиться один раз.
+
+        Кадр, который не удалось отправить, сервис не выполнял — повтор безопасен.
+        """
+        try:
+            if self._sock is None:
+                # После close() или обрыва соединения подключаемся заново
+                self._connect()
+            self._sock.sendall(frame)
+        except OSError:
+            self._disconnect()
+            if self._tx_depth:
+                # Сервис уже отменил транзакцию — молча продолжать в новом соединении нельзя
+                raise
+            # Сервис мог перезапуститься
+            self._connect()
+            self._sock.sendall(frame)
+
+    def _receive(self):
+        codec, length = HEADER.unpack(self._recv_exactly(HEADER.size))
+        return decode(codec, self._recv_exactly(length))
+
+    def call(self, method: str, *args, **kwargs):
+        """Вызвать метод CRM в сервисе"""
+        frame = encode(self.codec, {"m": method, "a": list(args), "k": kwargs})
+        with self._lock:
+            self._send(frame)
+            try:
+                response = self._receive()
+            except OSError:
+                # Соединение рассинхронизировано — следующий вызов откроет новое
+                self._disconnect()
+                if self._tx_depth or method not in RETRYABLE_METHODS:
+                    # Сервис мог выполнить изменение, а ответ потерялся: повтор задвоил бы запись
+                    raise ConnectionError(f"Соединение с сервисом CRM оборвалось во время {method}; "
+                                          "вызов мог быть выполнен")
+                self._send(frame)
+                response = self._receive()
+        if "e" in response:
+            error = REMOTE_EXCEPTIONS.get(response.get("t"))
+            if error is not None:
+                raise error(response["e"])
+            raise CRMRemoteError(f"{response.get('t')}: {response['e']}")
+        return response.get("r")
+
+    @contextmanager
+    def transaction(self):
+        """Группа изменений: пока блок выполняется, сервис не обслуживает других клиентов"""
+        self.call("begin")
+        self._tx_depth += 1
+        try:
+            try:
+                yield self
+            except BaseException:
+                self.call("rollback")
+                raise
+            self.call("commit")
+        finally:
+            self._tx_depth -= 1
+
+    batch = transaction
+
+    def __getattr__(self, name: str):
+        if name in REMOTE_METHODS or name in TRANSACTION_METHODS:
+            return functools.partial(self.call, name)
+        raise AttributeError(name)
+
+    def close(self):
+        """Закрыть соединение (сам сервис продолжает работать; следующий вызов подключится заново)"""
+        with self._lock:
+            self._disconnect()
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    from dotenv import load_dotenv
+    from simple_crm import create_crm
+
+    load_dotenv()
+
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else os.getenv("CRM_SOCKET", DEFAULT_SOCKET)
+    # Явный DATABASE_URL: сам сервис не должен подключаться к сокету как клиент
+    crm = create_crm(os.getenv("DATABASE_URL", ""), write_behind=True)
+    try:
+        asyncio.run(CRMServer(crm, socket_path).serve())
+    finally:
+        crm.close()
+        logger.info("Сервис CRM остановлен, данные сброшены на диск")
+
+
+if __name__ == "__main__":
+    main()
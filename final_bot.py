@@ -10,7 +10,8 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 import google.generativeai as genai
 from datetime import datetime, timedelta
-from simple_crm import SimpleCRM
+from simple_crm import create_crm
+from async_crm import AsyncSimpleCRM
 import json
 
 # Загружаем переменные окружения из .env файла
@@ -35,8 +36,9 @@ class FinalBonusEducationBot:
         # Создаем модель Gemini 2.0 Flash (по запросу)
         self.model = genai.GenerativeModel('models/gemini-2.0-flash')
         
-        # CRM сервис
-        self.crm = SimpleCRM()
+        # CRM сервис (отложенная запись: несколько изменений на одно сообщение — одна запись файла).
+        # Обработчики вызывают await self.crm...: запись идёт в отдельном потоке, а не в цикле событий
+        self.crm = AsyncSimpleCRM(create_crm(write_behind=True))
 
         # Простейшее состояние диалога для оформления записи
         # user_id -> {"intent": "booking", "name": str|None, "phone": str|None, "course": str|None,
@@ -232,7 +234,7 @@ class FinalBonusEducationBot:
             logger.info(f"Проверяем пользователя: {user.first_name} (ID: {user.id})")
             
             # Проверяем, есть ли пользователь уже в CRM
-            existing_user = self.crm.get_user(user.id)
+            existing_user = await self.crm.get_user(user.id)
             
             if not existing_user:
                 # Создаем нового пользователя с расширенными полями
@@ -256,12 +258,12 @@ class FinalBonusEducationBot:
                     "result": None,
                     "is_active": True
                 }
-                user_id = self.crm.add_user(user_data)
+                user_id = await self.crm.add_user(user_data)
                 logger.info(f"✅ НОВЫЙ пользователь зарегистрирован: {user.first_name} (ID: {user.id}) -> CRM ID: {user_id}")
-                logger.info(f"Всего пользователей в CRM: {len(self.crm.data['users'])}")
+                logger.info(f"Всего пользователей в CRM: {len(await self.crm.get_all_users())}")
             else:
                 # Обновляем активность существующего пользователя
-                self.crm.update_user_activity(user.id)
+                await self.crm.update_user_activity(user.id)
                 logger.info(f"🔄 Пользователь обновлен: {user.first_name} (ID: {user.id})")
                 
         except Exception as e:
@@ -293,7 +295,7 @@ class FinalBonusEducationBot:
     
     async def courses_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /courses"""
-        courses = self.crm.get_courses()
+        courses = await self.crm.get_courses()
         # Группируем по языку
         by_lang = {}
         for c in courses:
@@ -404,7 +406,7 @@ class FinalBonusEducationBot:
     
     async def show_booking_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню записи на курсы"""
-        courses = self.crm.get_courses()
+        courses = await self.crm.get_courses()
         
         keyboard = []
         for course in courses:
@@ -451,9 +453,9 @@ class FinalBonusEducationBot:
             detected_lang = self.detect_preferred_language(original_text)
             if detected_lang:
                 # Обновляем только при изменении или отсутствии значения
-                existing = self.crm.get_user(user.id) or {}
+                existing = (await self.crm.get_user(user.id)) or {}
                 if existing.get("preferred_language") != detected_lang:
-                    self.crm.update_user(existing.get("id") or existing.get("telegram_id") or user.id, {"preferred_language": detected_lang})
+                    await self.crm.update_user(existing.get("id") or existing.get("telegram_id") or user.id, {"preferred_language": detected_lang})
                     logger.info(f"🌐 Обновлен preferred_language: {detected_lang} для пользователя {user.id}")
         except Exception as e:
             logger.warning(f"Не удалось обновить preferred_language: {e}")
@@ -538,7 +540,7 @@ class FinalBonusEducationBot:
                         notes_extra.append(f"Время: {tf}")
                 if notes_extra:
                     booking_data['notes'] += " | " + "; ".join(notes_extra)
-                booking_id = self.crm.add_booking(booking_data)
+                booking_id = await self.crm.add_booking(booking_data)
                 # очищаем состояние
                 self.user_states.pop(user.id, None)
                 confirmation = (
@@ -600,7 +602,7 @@ class FinalBonusEducationBot:
                         extras.append(f"Время: {tf}")
                 if extras:
                     booking_data['notes'] += " | " + "; ".join(extras)
-                self.crm.add_booking(booking_data)
+                await self.crm.add_booking(booking_data)
                 self.user_states.pop(user.id, None)
                 confirmation = (
                     "✅ Заявка создана!\n\n"
@@ -625,7 +627,7 @@ class FinalBonusEducationBot:
         
         try:
             # Получаем последние диалоги для контекста
-            recent_conversations = self.crm.get_recent_conversations(user.id, 3)
+            recent_conversations = await self.crm.get_recent_conversations(user.id, 3)
             context = ""
             if recent_conversations:
                 context = "\n\nКонтекст предыдущих сообщений:\n"
@@ -643,14 +645,14 @@ class FinalBonusEducationBot:
                     f"Дай информацию и предложения применительно к '{lang_for_prompt}' (структура курсов, формат, цены как в центре аналогично турецкому направлению, без выдумывания несуществующих фактов)."\
                 )
             # Подхватываем системный промпт из CRM, если задан — онГлавнее встроенного
-            crm_prompt = self.crm.get_ai_system_prompt() if hasattr(self.crm, 'get_ai_system_prompt') else None
+            crm_prompt = await self.crm.get_ai_system_prompt() if hasattr(self.crm, 'get_ai_system_prompt') else None
             base_prompt = crm_prompt.strip() + "\n\n" if crm_prompt else self.system_prompt
             full_prompt = f"{base_prompt}{language_note}{context}\n\nТекущий вопрос пользователя: {user_message}\n\nОтветь естественно, учитывая контекст диалога. НЕ здоровайся заново, если это продолжение разговора."
             response = self.model.generate_content(full_prompt)
             ai_response = response.text.strip()
             
             # Сохраняем диалог в CRM
-            self.crm.add_conversation(user.id, user_message, ai_response)
+            await self.crm.add_conversation(user.id, user_message, ai_response)
             
         except Exception as e:
             logger.error(f"❌ Ошибка AI API: {e}")
@@ -707,7 +709,7 @@ class FinalBonusEducationBot:
                 logger.error(f"AI Error: {e}")
         
             # Сохраняем диалог с fallback ответом
-            self.crm.add_conversation(user.id, user_message, ai_response)
+            await self.crm.add_conversation(user.id, user_message, ai_response)
         
         # Отправляем ответ
         await update.message.reply_text(ai_response)
@@ -735,7 +737,7 @@ class FinalBonusEducationBot:
     
     async def handle_course_booking(self, query, course_id):
         """Обработка записи на курс"""
-        course = self.crm.get_course(course_id)
+        course = await self.crm.get_course(course_id)
         
         if not course:
             await query.edit_message_text("❌ Курс не найден. Попробуйте еще раз.")
@@ -754,7 +756,7 @@ class FinalBonusEducationBot:
             "notes": "Запись через Telegram бота"
         }
         
-        booking_id = self.crm.add_booking(booking_data)
+        booking_id = await self.crm.add_booking(booking_data)
         
         success_message = f"""
         ✅ Заявка на запись принята!
@@ -839,7 +841,7 @@ class FinalBonusEducationBot:
     
     async def send_courses_info(self, query):
         """Отправляет информацию о курсах через callback query"""
-        courses = self.crm.get_courses()
+        courses = await self.crm.get_courses()
         by_lang = {}
         for c in courses:
             lang = (c.get("language") or "Другое").strip()
@@ -949,7 +951,11 @@ class FinalBonusEducationBot:
     def run(self):
         """Запускает бота"""
         logger.info("Запуск Bonus Education Bot с CRM интеграцией...")
-        self.application.run_polling()
+        try:
+            self.application.run_polling()
+        finally:
+            # Сбрасываем отложенные изменения CRM на диск
+            self.crm.close()
 
 if __name__ == "__main__":
     try:
@@ -10,7 +10,7 @@ import asyncio
 from datetime import datetime
 from dotenv import load_dotenv
 import google.generativeai as genai
-from simple_crm import SimpleCRM
+from simple_crm import create_crm
 import json
 import re
 
@@ -33,8 +33,8 @@ class PersonalTelegramAssistant:
         # Создаем модель Gemini
         self.model = genai.GenerativeModel('models/gemini-2.0-flash')
         
-        # CRM сервис
-        self.crm = SimpleCRM()
+        # CRM сервис (отложенная запись; при выходе изменения сбрасываются на диск)
+        self.crm = create_crm(write_behind=True)
         
         # Состояния диалогов
         self.user_states = {}
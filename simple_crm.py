@@ -3,32 +3,817 @@
 Упрощенная CRM система без SQLAlchemy для демонстрации
 """
 
+import atexit
+import bisect
+import fcntl
+import functools
+import gzip
+import hashlib
+import heapq
 import json
+import logging
 import os
+import stat
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+from crm_models import DISPLAY_FIELDS_VERSION, MODELS, Conversation, materialize, now_ts, parse_ts, to_plain, ts_from_datetime
+
+def normalize_course(course: Dict) -> Dict:
+    """Нормализовать структуру курса"""
+    return {
+        "id": course.get("id"),
+        "name": course.get("name"),
+        "description": course.get("description"),
+        "duration": course.get("duration", f"{course.get('duration_months', 2)} месяца"),
+        "duration_months": course.get("duration_months", None),
+        "level": course.get("level"),
+        "status": course.get("status"),
+        "language": course.get("language", "Турецкий"),
+        "price": course.get("price", "Уточняется на консультации"),
+        "is_active": course.get("is_active", True),
+        # Поля расписания (необязательные)
+        "days": course.get("days", []),
+        "time_from": course.get("time_from"),
+        "time_to": course.get("time_to"),
+        "teacher_id": course.get("teacher_id"),
+        "teacher_name": course.get("teacher_name")
+    }
+
+def normalize_teacher(teacher: Dict) -> Dict:
+    """Нормализовать структуру преподавателя"""
+    # Нормализуем языки: допускаем как список, так и строку
+    raw_languages = teacher.get("languages")
+    if isinstance(raw_languages, list):
+        languages = raw_languages
+    elif isinstance(raw_languages, str) and raw_languages.strip():
+        # Разбиваем по запятой, игнорируя пробелы
+        languages = [lng.strip() for lng in raw_languages.split(",") if lng.strip()]
+    else:
+        languages = ["турецкий", "русский"]
+
+    return {
+        "id": teacher.get("id"),
+        "name": teacher.get("name"),
+        "specialization": teacher.get("specialization"),
+        "experience": f"{teacher.get('experience_years', 5)} лет",
+        "languages": languages,
+        "is_active": teacher.get("is_active", True)
+    }
+
+logger = logging.getLogger(__name__)
+
+def atomic_write_text(path: str, text: str):
+    """Записать файл атомарно: временный файл, fsync, rename.
+
+    Читатели видят либо старую, либо новую версию файла целиком, но не обрезанную.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp создаёт файл с правами 0600 — сохраняем права исходного файла,
+        # а новый файл получает обычные права, как у open(): 0666 без umask
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    # fsync каталога, чтобы переименование пережило сбой питания (где это поддерживается)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+@contextmanager
+def locked_file(path: str):
+    """Эксклюзивная блокировка flock на файле path (создаётся при необходимости) на время блока"""
+    with open(path, 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield f
+
+def synchronized(method):
+    """Выполнять метод под блокировкой хранилища (данные читает фоновый поток записи)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def statistics_view(counters: Dict) -> Dict:
+    """Статистика для панели: счётчики плюс {статус}_bookings для каждого статуса записи"""
+    stats = dict(counters)
+    stats["bookings_by_status"] = dict(counters.get("bookings_by_status", {}))
+    stats["users_by_source"] = dict(counters.get("users_by_source", {}))
+    for status, count in stats["bookings_by_status"].items():
+        stats[f"{status}_bookings"] = count
+    return stats
+
+# Архив: через сколько дней диалоги и закрытые записи уходят из рабочих файлов
+ARCHIVE_AFTER_DAYS = 90
+
+# Статусы записей, которые больше не меняются и могут уйти в архив
+CLOSED_BOOKING_STATUSES = {"success", "failed", "confirmed", "cancelled", "won", "lost", "inactive"}
+
+# Поле с telegram_id пользователя в архивируемых коллекциях
+ARCHIVE_TELEGRAM_FIELDS = {"conversations": "telegram_id", "bookings": "user_id"}
+
+def append_archive(archive_dir: str, collection: str, records: List[Dict]):
+    """Дописать записи в помесячные сегменты архива (gzip JSONL, по created_at)"""
+    by_month = {}
+    for record in records:
+        by_month.setdefault(record["created_at"][:7], []).append(record)
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, month_records in sorted(by_month.items()):
+        lines = "".join(json.dumps(r, ensure_ascii=False, default=to_plain) + "\n" for r in month_records).encode("utf-8")
+        # Дописывание в gzip добавляет новый поток; при чтении потоки склеиваются
+        with gzip.open(os.path.join(archive_dir, f"{collection}-{month}.jsonl.gz"), 'ab') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileobj.fileno())
+
+def read_archive(archive_dir: str, collection: str, telegram_id: Optional[int] = None,
+                 date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[Dict]:
+    """Найти записи архива по telegram_id и периоду (даты ISO, date_to включительно).
+
+    Читаются только сегменты месяцев, попадающих в период.
+    """
+    if not os.path.isdir(archive_dir):
+        return []
+    prefix = f"{collection}-"
+    records = []
+    seen = set()
+    for name in sorted(os.listdir(archive_dir)):
+        if not (name.startswith(prefix) and name.endswith(".jsonl.gz")):
+            continue
+        month = name[len(prefix):-len(".jsonl.gz")]
+        if (date_from and month < date_from[:7]) or (date_to and month > date_to[:7]):
+            continue
+        with gzip.open(os.path.join(archive_dir, name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if telegram_id is not None and record.get(ARCHIVE_TELEGRAM_FIELDS[collection]) != telegram_id:
+                    continue
+                created_at = record.get("created_at", "")
+                if date_from and created_at < date_from:
+                    continue
+                # date_to может быть датой без времени — сравниваем по её длине
+                if date_to and created_at[:len(date_to)] > date_to:
+                    continue
+                # После сбоя посреди архивации запись могла попасть в архив дважды
+                key = (record.get("id"), created_at)
+                if key not in seen:
+                    seen.add(key)
+                    records.append(record)
+    records.sort(key=lambda x: x.get("created_at", ""))
+    return records
+
+# Журнал изменений: тип события — <запись>_<действие>, например user_added, booking_status_changed
+CHANGE_ENTITIES = {
+    "users": "user", "bookings": "booking", "conversations": "conversation",
+    "courses": "course", "teachers": "teacher", "employees": "employee",
+}
+
+# Поля, которые не попадают в журнал изменений
+CHANGE_HIDDEN_FIELDS = {"password_hash"}
+
+# Сколько дней хранить журнал изменений: его читатели отстают на секунды,
+# а вкладка, отставшая сильнее, чем помнит панель, всё равно перезагружается
+CHANGES_KEEP_DAYS = 7
+
+def change_event(event_type: str, collection: Optional[str], record_id=None, data: Optional[Dict] = None) -> Dict:
+    """Событие изменения (seq назначается при записи в журнал)"""
+    event = {"type": event_type, "collection": collection, "id": record_id, "ts": datetime.now().isoformat()}
+    if data:
+        event["data"] = {k: v for k, v in dict(data).items() if k not in CHANGE_HIDDEN_FIELDS}
+    return event
+
+def update_event(collection: str, record_id, old_status, changes: Dict) -> Dict:
+    """Событие обновления; смена статуса пользователя или записи — отдельный тип события"""
+    if collection in ("users", "bookings") and "status" in changes and str(changes["status"]) != str(old_status):
+        return change_event(f"{CHANGE_ENTITIES[collection]}_status_changed", collection, record_id,
+                            dict(changes, old_status=old_status))
+    return change_event(f"{CHANGE_ENTITIES[collection]}_updated", collection, record_id, changes)
+
+def _last_change_seq(f) -> int:
+    """seq последнего целого события в журнале (файл открыт в двоичном режиме)"""
+    pos = f.seek(0, os.SEEK_END)
+    tail = b""
+    while pos > 0:
+        step = min(65536, pos)
+        pos -= step
+        f.seek(pos)
+        tail = f.read(step) + tail
+        lines = tail.split(b"\n")
+        # Первая строка куска может быть неполной, если читали не с начала файла
+        for line in reversed(lines if pos == 0 else lines[1:]):
+            try:
+                return json.loads(line)["seq"]
+            except (ValueError, KeyError, TypeError):
+                continue
+    return 0
+
+def append_changes(path: str, events: List[Dict]) -> List[Dict]:
+    """Дописать события в журнал, назначив им seq.
+
+    Журнал блокируется на время записи, поэтому номера не повторяются,
+    даже если его дописывают несколько процессов.
+    """
+    with locked_file(changes_lock(path)), open(path, 'a+b') as f:
+        seq = _last_change_seq(f)
+        numbered = []
+        for event in events:
+            seq += 1
+            numbered.append({"seq": seq, **event})
+        lines = "".join(json.dumps(e, ensure_ascii=False, default=to_plain) + "\n" for e in numbered).encode("utf-8")
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b"\n":
+                # Хвост от прерванной записи — начинаем с новой строки
+                lines = b"\n" + lines
+        f.write(lines)
+        f.flush()
+    return numbered
+
+def changes_lock(path: str) -> str:
+    """Файл блокировки журнала изменений (сам журнал при обрезке заменяется через rename)"""
+    return os.path.splitext(path)[0] + ".lock"
+
+def trim_changes(path: str, before: str) -> int:
+    """Удалить из журнала события с ts раньше before (ISO); возвращает их число.
+
+    Последнее событие остаётся всегда — от него продолжается нумерация seq.
+    """
+    with locked_file(changes_lock(path)):
+        try:
+            with open(path, 'rb') as f:
+                lines = f.read().splitlines(keepends=True)
+        except FileNotFoundError:
+            return 0
+        keep_from = 0
+        for i, line in enumerate(lines[:-1]):
+            try:
+                ts = json.loads(line).get("ts") or ""
+            except (ValueError, AttributeError):
+                # Повреждённая строка уходит вместе со старыми событиями
+                ts = ""
+            if ts >= before:
+                break
+            keep_from = i + 1
+        if keep_from:
+            atomic_write_text(path, b"".join(lines[keep_from:]).decode("utf-8"))
+    return keep_from
+
+def read_changes_log(path: str, since_seq: int = 0, limit: Optional[int] = None,
+                     start: int = 0, start_seq: int = 0) -> Tuple[List[Dict], int, int]:
+    """События с seq > since_seq начиная с байта start.
+
+    Возвращает (события, позиция после последней прочитанной строки, её seq).
+    """
+    events = []
+    offset, last_seq = start, start_seq
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return events, 0, 0
+    with f:
+        f.seek(start)
+        while limit is None or len(events) < limit:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            last_seq = event.get("seq", last_seq)
+            if last_seq > since_seq:
+                events.append(event)
+    return events, offset, last_seq
+
+# Тексты диалогов от этой длины хранятся один раз в таблице текстов, а в журнале — только их хеш
+TEXT_STORE_MIN_LENGTH = 64
+TEXT_STORE_FIELDS = ("message", "response")
+
+def text_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+# Коллекции, для которых поддерживается индекс id -> запись
+INDEXED_COLLECTIONS = ("users", "bookings", "courses", "teachers", "employees")
+
+# Коллекции в отдельных файлах рядом с основным: {коллекция: загружать лениво}.
+# Справочники (курсы, преподаватели, сотрудники, промпты) остаются в основном файле
+SPLIT_COLLECTIONS = {"users": False, "bookings": True}
+
+# Коллекции, которые читаются с диска только при первом обращении
+LAZY_COLLECTIONS = ("bookings", "conversations")
+
+# Коллекции, которые обычно дописываются по возрастанию created_at
+TIME_ORDERED_COLLECTIONS = ("bookings", "conversations")
+
+# Счётчики статистики, которые относятся к каждой коллекции
+STATISTICS_FIELDS = {
+    "users": {"total_users": 0, "users_by_source": {}},
+    "bookings": {"total_bookings": 0, "bookings_by_status": {}},
+    "conversations": {"total_conversations": 0},
+    "courses": {"total_courses": 0, "active_courses": 0},
+    "teachers": {"total_teachers": 0, "active_teachers": 0},
+    "employees": {"total_employees": 0},
+}
+
+# Сколько последних диалогов каждого пользователя держать под рукой для контекста AI
+RECENT_CONVERSATIONS_PER_USER = 20
+
+# query_users / query_bookings: ключи сортировки и поля текстового поиска
+QUERY_SORT_KEYS = {
+    "users": ("created_at", "last_activity", "id"),
+    "bookings": ("created_at", "id"),
+}
+QUERY_TEXT_FIELDS = {
+    "users": ("first_name", "last_name", "username", "phone", "instagram_username"),
+    "bookings": ("user_name", "user_phone", "course_name", "teacher_name"),
+}
+# Поле с telegram_id: поиск из одних цифр сравнивается с ним точно
+QUERY_TELEGRAM_FIELDS = {"users": "telegram_id", "bookings": "user_id"}
+
+def query_date_range(date_from: Optional[str], date_to: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Период фильтра по created_at: [date_from, date_to). Дата без времени в date_to — включительно"""
+    try:
+        lower = datetime.fromisoformat(date_from).isoformat() if date_from else None
+        upper = datetime.fromisoformat(date_to) if date_to else None
+    except ValueError:
+        raise ValueError(f"Неверная дата: {date_from or ''}..{date_to or ''}")
+    if upper is not None and len(date_to) == 10:
+        upper += timedelta(days=1)
+    return lower, upper.isoformat() if upper is not None else None
+
+def query_page(items: List[Dict], total: int, offset: int, limit: int) -> Dict:
+    return {"items": items, "total": total, "offset": offset, "limit": limit}
 
 class SimpleCRM:
-    def __init__(self, data_file: str = "crm_data.json"):
+    def __init__(self, data_file: str = "crm_data.json", fsync_conversations: bool = False,
+                 write_behind: bool = False, flush_interval_ms: int = 200, flush_max_mutations: int = 50,
+                 compact: bool = False, read_only: bool = False):
         self.data_file = data_file
-        self.data = self.load_data()
+        # Только чтение (импорт в другое хранилище): старый формат не раскладывается по файлам,
+        # любая запись поднимает RuntimeError
+        self.read_only = read_only
+        # Компактный JSON без отступов: меньше файл и быстрее разбор при перечитывании
+        self.compact = compact
+        self._lock = threading.RLock()
+        # Диалоги хранятся в отдельном журнале (одна JSON-строка на сообщение),
+        # чтобы запись ответа бота не переписывала весь файл данных
+        self.conversations_log = os.path.splitext(data_file)[0] + ".conversations.jsonl"
+        # Блокировка журнала: дописывание и переписывание при архивации не перемежаются.
+        # Отдельный файл, потому что сам журнал при архивации заменяется через rename
+        self.conversations_lock = os.path.splitext(data_file)[0] + ".conversations.lock"
+        self.fsync_conversations = fsync_conversations
+        # Таблица повторяющихся текстов (шаблонные ответы, блоки контактов): хеш -> текст
+        self.texts_log = os.path.splitext(data_file)[0] + ".texts.jsonl"
+        self._texts = {}
+        self._texts_offset = 0
+        # Журнал изменений (события с номерами seq) и подписчики в этом процессе
+        self.changes_log = os.path.splitext(data_file)[0] + ".changes.jsonl"
+        self._subscribers = []
+        self._changes_cursor = None
+        # Помесячные сегменты со старыми диалогами и закрытыми записями
+        self.archive_dir = os.path.splitext(data_file)[0] + ".archive"
+        # Отпечатки файлов (mtime, размер, inode) на момент последнего чтения/записи
+        self._signatures = {}
+        self._log_signature = None
+        # Сколько байт журнала уже прочитано, и свои строки, которые вернутся при дочитывании
+        self._log_offset = 0
+        self._own_unread = set()
+
+        # Отложенная запись: изменения копятся в памяти и сбрасываются одной записью
+        # раз в flush_interval_ms или после flush_max_mutations изменений
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_mutations = flush_max_mutations
+        self._dirty = set()
+        self._mutations = 0
+        self._pending_conversations = []
+        self._pending_changes = []
+        self._closed = False
+        self._flusher = None
+
+        # Транзакция: файлы и диалоги, которые будут записаны при commit()
+        self._tx_depth = 0
+        self._tx_files = set()
+        self._tx_conversations = []
+        self._tx_changes = []
+        self._tx_failed = False
+
+        self._data = self.load_data()
+
+        if write_behind:
+            self._wakeup = threading.Condition(self._lock)
+            self._flusher = threading.Thread(target=self._flush_loop, name="crm-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    @property
+    def data(self) -> Dict:
+        """Все данные CRM (ленивые коллекции при этом загружаются)"""
+        for collection in LAZY_COLLECTIONS:
+            self._require(collection)
+        return self._data
+
+    def _require(self, collection: str):
+        """Загрузить ленивую коллекцию при первом обращении"""
+        if collection in self._loaded:
+            return
+        with self._lock:
+            if collection in self._loaded:
+                return
+            if collection == "conversations":
+                self._data["conversations"] = self._load_conversations(self._legacy_conversations)
+                self._legacy_conversations = []
+                self._index_conversations()
+            else:
+                self._data[collection] = self._load_split(collection)
+                self._index_collection(collection)
+            self._loaded.add(collection)
+
+    def _index_collection(self, collection: str):
+        """Построить словари для поиска за O(1) по одной коллекции.
+
+        Словари ключей строятся заново и подменяются целиком: чтение без блокировки
+        (AsyncSimpleCRM) во время перестройки видит старый индекс, а не пустой.
+        """
+        if collection in QUERY_SORT_KEYS:
+            # kanban_status -> {id(запись): запись}: фильтр по статусу без обхода коллекции
+            self._by_status[collection] = {}
+        indexes = [(field, {}) for field, _ in self._key_indexes(collection)]
+        for field, _ in indexes:
+            self._key_duplicates.pop((collection, field), None)
+        self._reset_statistics(collection)
+        for record in self._data.get(collection, []):
+            self._index_values(collection, record)
+            for field, index in indexes:
+                self._add_key(collection, field, index, record)
+        self._set_key_indexes(collection, dict(indexes))
+        if collection == "users":
+            # Пользователи по возрастанию last_activity: два параллельных списка для bisect
+            ordered = sorted(self._data.get("users", []), key=lambda u: u.timestamp("last_activity"))
+            self._activity_ts = [u.timestamp("last_activity") for u in ordered]
+            self._activity_users = ordered
+        if collection in TIME_ORDERED_COLLECTIONS:
+            self._time_ordered[collection] = self._is_time_ordered(self._data[collection])
+
+    @staticmethod
+    def _is_time_ordered(records: List[Dict]) -> bool:
+        return all(records[i - 1].timestamp("created_at") <= records[i].timestamp("created_at")
+                   for i in range(1, len(records)))
+
+    def _note_appended(self, collection: str):
+        """Проверить, что новая запись не нарушила порядок по created_at"""
+        records = self._data[collection]
+        if len(records) > 1 and records[-2].timestamp("created_at") > records[-1].timestamp("created_at"):
+            self._time_ordered[collection] = False
+
+    def _latest(self, collection: str, limit: int) -> List[Dict]:
+        """Последние limit записей по created_at без сортировки всей коллекции"""
+        self._require(collection)
+        records = self._data[collection]
+        if limit <= 0:
+            return []
+        if self._time_ordered[collection]:
+            return records[:-limit - 1:-1]
+        return heapq.nlargest(limit, records, key=lambda x: x.timestamp("created_at"))
+
+    def _index_conversations(self):
+        """Заполнить для каждого пользователя кольцевой буфер последних диалогов"""
+        # Буферы строятся заново и подменяются целиком, как словари ключей в _index_collection
+        recent_by_user = {}
+        self._reset_statistics("conversations")
+        for conversation in self._data.get("conversations", []):
+            self._index_conversation(conversation, recent_by_user)
+        self._recent_by_user = recent_by_user
+        self._time_ordered["conversations"] = self._is_time_ordered(self._data["conversations"])
+
+    def _index_conversation(self, conversation: Dict, recent_by_user: Optional[Dict] = None):
+        if recent_by_user is None:
+            recent_by_user = self._recent_by_user
+        self._observe_id("conversations", conversation.get("id"))
+        self._stats["total_conversations"] += 1
+        self._bump(self._conversations_by_user, conversation.get("telegram_id"), 1)
+        recent = recent_by_user.get(conversation.get("telegram_id"))
+        if recent is None:
+            recent = recent_by_user[conversation.get("telegram_id")] = deque(maxlen=RECENT_CONVERSATIONS_PER_USER)
+        recent.append(conversation)
+
+    def _reset_statistics(self, collection: str):
+        """Обнулить счётчики коллекции; дальше они меняются только вместе с индексами"""
+        for key, value in STATISTICS_FIELDS[collection].items():
+            self._stats[key] = dict(value) if isinstance(value, dict) else value
+        # Счётчики по пользователям (telegram_id): диалоги, записи, записи по курсам
+        if collection == "conversations":
+            self._conversations_by_user = {}
+        elif collection == "bookings":
+            self._bookings_by_user = {}
+            self._courses_by_user = {}
+
+    @staticmethod
+    def _bump(counter: Dict, key, delta: int):
+        counter[key] = counter.get(key, 0) + delta
+        if not counter[key]:
+            del counter[key]
+
+    def _count_record(self, collection: str, record: Dict, delta: int):
+        """Учесть запись в счётчиках (delta = 1 при добавлении, -1 при удалении)"""
+        stats = self._stats
+        if collection == "users":
+            stats["total_users"] += delta
+            self._bump(stats["users_by_source"], record.get("source") or "unknown", delta)
+        elif collection == "bookings":
+            stats["total_bookings"] += delta
+            self._bump(stats["bookings_by_status"], record.get("status") or "unknown", delta)
+            telegram_id = record.get("user_id")
+            self._bump(self._bookings_by_user, telegram_id, delta)
+            if record.get("course_id") is not None:
+                courses = self._courses_by_user.setdefault(telegram_id, {})
+                self._bump(courses, record.get("course_id"), delta)
+                if not courses:
+                    del self._courses_by_user[telegram_id]
+        elif collection in ("courses", "teachers"):
+            stats[f"total_{collection}"] += delta
+            if record.get("is_active", True):
+                stats[f"active_{collection}"] += delta
+        elif collection == "employees":
+            stats["total_employees"] += delta
+
+    def _observe_id(self, collection: str, record_id):
+        sequences = self._data["sequences"]
+        if isinstance(record_id, int) and record_id > sequences.get(collection, 0):
+            sequences[collection] = record_id
+
+    def _next_id(self, collection: str) -> int:
+        """Следующий id коллекции: O(1) и без повторов даже после удалений"""
+        sequences = self._data["sequences"]
+        sequences[collection] = sequences.get(collection, 0) + 1
+        return sequences[collection]
+
+    def _index_activity(self, user):
+        ts = user.timestamp("last_activity")
+        i = bisect.bisect_right(self._activity_ts, ts)
+        self._activity_ts.insert(i, ts)
+        self._activity_users.insert(i, user)
+
+    def _unindex_activity(self, user):
+        ts = user.timestamp("last_activity")
+        i = bisect.bisect_left(self._activity_ts, ts)
+        while i < len(self._activity_ts) and self._activity_ts[i] == ts:
+            if self._activity_users[i] is user:
+                del self._activity_ts[i]
+                del self._activity_users[i]
+                return
+            i += 1
+
+    def _key_indexes(self, collection: str) -> List[Tuple[str, Dict]]:
+        """Словари поиска коллекции: (поле, значение -> первая запись с этим значением)"""
+        indexes = [("id", self._by_id[collection])]
+        if collection == "users":
+            indexes.append(("telegram_id", self._users_by_telegram_id))
+        elif collection == "employees":
+            indexes.append(("username", self._employees_by_username))
+        return indexes
+
+    def _set_key_indexes(self, collection: str, indexes: Dict[str, Dict]):
+        self._by_id[collection] = indexes["id"]
+        if collection == "users":
+            self._users_by_telegram_id = indexes["telegram_id"]
+        elif collection == "employees":
+            self._employees_by_username = indexes["username"]
+
+    def _add_key(self, collection: str, field: str, index: Dict, record: Dict):
+        # При дублях, как и при линейном поиске, находится первая запись; остальные ждут в очереди
+        value = record.get(field)
+        if value in index:
+            self._key_duplicates.setdefault((collection, field), {}).setdefault(value, []).append(record)
+        else:
+            index[value] = record
+
+    def _drop_key(self, collection: str, field: str, index: Dict, record: Dict, value):
+        duplicates = self._key_duplicates.get((collection, field), {})
+        others = duplicates.get(value)
+        if index.get(value) is record:
+            if others:
+                # Индекс переходит к следующей записи с тем же ключом — без обхода коллекции
+                index[value] = others.pop(0)
+            else:
+                del index[value]
+        elif others:
+            others[:] = [r for r in others if r is not record]
+        if others is not None and not others:
+            del duplicates[value]
+
+    def _index_values(self, collection: str, record: Dict):
+        """Учесть запись в счётчиках и индексе статусов"""
+        self._observe_id(collection, record.get("id"))
+        self._count_record(collection, record, 1)
+        if collection in QUERY_SORT_KEYS:
+            self._by_status[collection].setdefault(record.get("kanban_status"), {})[id(record)] = record
+
+    def _unindex_values(self, collection: str, record: Dict):
+        self._count_record(collection, record, -1)
+        if collection in QUERY_SORT_KEYS:
+            same_status = self._by_status[collection].get(record.get("kanban_status"), {})
+            same_status.pop(id(record), None)
+            if not same_status:
+                self._by_status[collection].pop(record.get("kanban_status"), None)
+
+    def _index_record(self, collection: str, record: Dict):
+        # Поля для отображения пересчитываются только при записи; при загрузке берутся из файла
+        materialize(collection, record)
+        self._index_values(collection, record)
+        if collection == "users":
+            self._index_activity(record)
+        for field, index in self._key_indexes(collection):
+            self._add_key(collection, field, index, record)
+
+    def _unindex_record(self, collection: str, record: Dict):
+        self._unindex_values(collection, record)
+        if collection == "users":
+            self._unindex_activity(record)
+        for field, index in self._key_indexes(collection):
+            self._drop_key(collection, field, index, record, record.get(field))
+
+    def _update_record(self, collection: str, record: Dict, changes: Dict):
+        """Обновить запись с сохранением согласованности индексов.
+
+        Ключи поиска и индекс активности трогаются, только если их значение меняется:
+        запись не выпадает из get_user() на время обновления, и обновление стоит O(1).
+        """
+        old_status = record.get("status")
+        old_keys = [(field, index, record.get(field)) for field, index in self._key_indexes(collection)]
+        self._unindex_values(collection, record)
+        if collection == "users" and "last_activity" in changes:
+            self._unindex_activity(record)
+        record.update(changes)
+        materialize(collection, record)
+        self._index_values(collection, record)
+        if collection == "users" and "last_activity" in changes:
+            self._index_activity(record)
+        for field, index, old_value in old_keys:
+            if record.get(field) != old_value:
+                self._drop_key(collection, field, index, record, old_value)
+                self._add_key(collection, field, index, record)
+        if "created_at" in changes and collection in TIME_ORDERED_COLLECTIONS:
+            self._time_ordered[collection] = self._is_time_ordered(self._data[collection])
+        self._emit(update_event(collection, record.get("id"), old_status, changes))
+
+    def _remove_record(self, collection: str, record: Dict):
+        """Удалить запись из коллекции и индексов"""
+        records = self._data[collection]
+        for i, r in enumerate(records):
+            if r is record:
+                del records[i]
+                break
+        self._unindex_record(collection, record)
+        self._emit(change_event(f"{CHANGE_ENTITIES[collection]}_deleted", collection, record.get("id")))
     
+    @staticmethod
+    def _file_signature(path: str):
+        """Отпечаток файла: меняется при любой перезаписи или дописывании"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _path(self, key: str) -> str:
+        """Путь к файлу: "main" — основной файл, иначе файл коллекции"""
+        if key == "main":
+            return self.data_file
+        return f"{os.path.splitext(self.data_file)[0]}.{key}.json"
+
+    def _changed(self, key: str) -> bool:
+        signature = self._file_signature(self._path(key))
+        return signature is not None and signature != self._signatures.get(key)
+
+    def _read_json(self, key: str):
+        """Прочитать файл хранилища; None, если его нет, ValueError, если он повреждён"""
+        path = self._path(key)
+        signature = self._file_signature(path)
+        if signature is None:
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = json.load(f)
+        except ValueError as e:
+            logger.error(f"Файл данных CRM {path} повреждён: {e}")
+            raise
+        self._signatures[key] = signature
+        return content
+
+    def _load_main(self) -> Dict:
+        """Прочитать основной файл (справочники, настройки, счётчики id)"""
+        data = self._read_json("main")
+        if data is None:
+            # Инициализация с тестовыми данными
+            data = self._seed_data()
+        # Убеждаемся, что есть секция employees
+        if "employees" not in data:
+            data["employees"] = []
+        # Секция AI промптов
+        if "ai_prompts" not in data:
+            data["ai_prompts"] = {"system_prompt": None}
+        # Счётчики пересчитываются при загрузке, в файле они не нужны
+        data.pop("statistics", None)
+        # Производные поля хранятся в файле; пересчитываем их, только если файл записан старой версией
+        stale = data.get("display_fields", 0) < DISPLAY_FIELDS_VERSION
+        for collection, model in MODELS.items():
+            if collection in data and collection != "conversations":
+                data[collection] = [model.from_dict(record) for record in data[collection]]
+                if stale:
+                    for record in data[collection]:
+                        materialize(collection, record)
+        data["display_fields"] = DISPLAY_FIELDS_VERSION
+        data.setdefault("sequences", {})
+        return data
+
+    def _load_split(self, collection: str) -> List[Dict]:
+        """Прочитать коллекцию из её файла"""
+        content = self._read_json(collection)
+        if content is None:
+            return []
+        self._observe_id(collection, content.get("sequence"))
+        model = MODELS[collection]
+        records = [model.from_dict(record) for record in content.get("records", [])]
+        if content.get("display_fields", 0) < DISPLAY_FIELDS_VERSION:
+            for record in records:
+                materialize(collection, record)
+        return records
+
     def load_data(self) -> Dict:
-        """Загрузить данные из файла"""
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Убеждаемся, что есть секция employees
-                    if "employees" not in data:
-                        data["employees"] = []
-                    # Секция AI промптов
-                    if "ai_prompts" not in data:
-                        data["ai_prompts"] = {"system_prompt": None}
-                    return data
-            except:
-                pass        
-        # Инициализация с тестовыми данными
+        """Загрузить данные с диска.
+
+        Сразу читаются основной файл и пользователи; записи и диалоги — при
+        первом обращении. Повреждённый файл не подменяется тестовыми данными
+        (иначе следующее сохранение затёрло бы CRM) — вместо этого поднимается ValueError.
+        """
+        main = self._load_main()
+        # Коллекции, которые старые версии хранили прямо в основном файле
+        legacy = {key: main.pop(key) for key in list(SPLIT_COLLECTIONS) + ["conversations"] if key in main}
+        self._data = main
+        self._loaded = set()
+        self._legacy_conversations = legacy.pop("conversations", None) or []
+        self._by_id = {collection: {} for collection in INDEXED_COLLECTIONS}
+        self._by_status = {collection: {} for collection in QUERY_SORT_KEYS}
+        self._users_by_telegram_id = {}
+        self._employees_by_username = {}
+        # (коллекция, поле) -> {значение: записи с тем же ключом после первой}
+        self._key_duplicates = {}
+        self._recent_by_user = {}
+        self._time_ordered = {}
+        self._stats = {}
+        for collection in STATISTICS_FIELDS:
+            self._reset_statistics(collection)
+        for collection in ("courses", "teachers", "employees"):
+            self._index_collection(collection)
+
+        for collection, lazy in SPLIT_COLLECTIONS.items():
+            if collection in legacy and self._file_signature(self._path(collection)) is None:
+                self._data[collection] = legacy[collection]
+                self._index_collection(collection)
+                self._loaded.add(collection)
+            elif not lazy:
+                self._require(collection)
+
+        if legacy and "main" in self._signatures and not self.read_only:
+            # Один раз раскладываем старый общий файл по файлам коллекций
+            for collection in LAZY_COLLECTIONS:
+                self._require(collection)
+            self._write_files(set(SPLIT_COLLECTIONS) | {"main"})
+        return self._data
+
+    def _seed_data(self) -> Dict:
+        """Начальные данные для пустой CRM"""
         return {
             "users": [],
             "courses": [
@@ -139,344 +924,993 @@ class SimpleCRM:
             }
         }
     
-    def save_data(self):
-        """Сохранить данные в файл"""
-        with open(self.data_file, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+    def _load_conversations(self, legacy: List[Dict]) -> List[Dict]:
+        """Восстановить список диалогов из журнала.
+
+        Диалоги, которые остались в самом файле данных от старого формата,
+        один раз дописываются в журнал и дальше живут только там.
+        """
+        self._log_offset = 0
+        self._own_unread = set()
+        conversations = self._read_conversations_tail()
+        seen = {(c.get("id"), c.get("created_at")) for c in conversations}
+
+        missing = [Conversation.from_dict(c) for c in legacy if (c.get("id"), c.get("created_at")) not in seen]
+        if missing:
+            if not self.read_only:
+                self._append_conversations(missing)
+            conversations = missing + conversations
+            conversations.sort(key=lambda x: x.timestamp("created_at"))
+        return conversations
+
+    def _read_conversations_tail(self) -> List[Dict]:
+        """Прочитать из журнала строки, дописанные после self._log_offset"""
+        self._log_signature = self._file_signature(self.conversations_log)
+        if self._log_signature is None:
+            return []
+        with open(self.conversations_log, 'rb') as f:
+            f.seek(self._log_offset)
+            chunk = f.read()
+        # Недописанная строка (падение или запись посреди чтения) остаётся на следующий раз
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        self._log_offset += len(complete)
+        conversations = []
+        for line in complete.splitlines():
+            try:
+                conversation = Conversation(self._unpack_conversation(json.loads(line)))
+            except ValueError:
+                continue
+            key = (conversation.get("id"), conversation.get("created_at"))
+            if key in self._own_unread:
+                # Эта строка записана нами и уже есть в памяти
+                self._own_unread.discard(key)
+                continue
+            conversations.append(conversation)
+        return conversations
+
+    def _read_texts_tail(self):
+        """Дочитать таблицу текстов (её дописывают и другие процессы)"""
+        if self._file_signature(self.texts_log) is None:
+            return
+        with open(self.texts_log, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < self._texts_offset:
+                # Файл заменили — читаем заново
+                self._texts_offset = 0
+            f.seek(self._texts_offset)
+            chunk = f.read()
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        self._texts_offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self._texts.setdefault(entry["h"], entry["t"])
+
+    def _text(self, digest: str) -> str:
+        if digest not in self._texts:
+            self._read_texts_tail()
+        if digest not in self._texts:
+            logger.error(f"Текст {digest} не найден в {self.texts_log}")
+            return ""
+        return self._texts[digest]
+
+    def _shared_text(self, text):
+        """Уже известный длинный текст — тот же объект строки, что и в таблице текстов"""
+        if isinstance(text, str) and len(text) >= TEXT_STORE_MIN_LENGTH:
+            return self._texts.get(text_digest(text), text)
+        return text
+
+    def _unpack_conversation(self, stored: Dict) -> Dict:
+        """Подставить тексты вместо ссылок (одна строка в памяти на все повторы)"""
+        for field in TEXT_STORE_FIELDS:
+            digest = stored.pop(f"{field}_ref", None)
+            if digest is not None:
+                stored[field] = self._text(digest)
+        return stored
+
+    def _pack_conversations(self, conversations: List[Dict]) -> str:
+        """Строки журнала: длинные тексты заменяются хешами, новые тексты дописываются в таблицу"""
+        new_texts = {}
+        lines = []
+        for conversation in conversations:
+            stored = dict(conversation)
+            for field in TEXT_STORE_FIELDS:
+                text = stored.get(field)
+                if not isinstance(text, str) or len(text) < TEXT_STORE_MIN_LENGTH:
+                    continue
+                digest = text_digest(text)
+                if digest not in self._texts:
+                    new_texts[digest] = text
+                del stored[field]
+                stored[f"{field}_ref"] = digest
+            lines.append(json.dumps(stored, ensure_ascii=False) + "\n")
+        if new_texts:
+            # Тексты пишутся раньше журнала: ссылка в журнале всегда разрешима
+            entries = "".join(json.dumps({"h": h, "t": t}, ensure_ascii=False) + "\n" for h, t in new_texts.items())
+            with open(self.texts_log, 'ab') as f:
+                f.write(entries.encode("utf-8"))
+                f.flush()
+                if self.fsync_conversations:
+                    os.fsync(f.fileno())
+            self._texts.update(new_texts)
+        return "".join(lines)
+
+    def _append_conversations(self, conversations: List[Dict]):
+        """Дописать диалоги в конец журнала"""
+        self._check_writable()
+        lines = self._pack_conversations(conversations).encode("utf-8")
+        # Та же блокировка, что и у archive(): строки не попадут в журнал, который сейчас переписывается
+        with locked_file(self.conversations_lock), open(self.conversations_log, 'ab') as f:
+            f.write(lines)
+            f.flush()
+            if self.fsync_conversations:
+                os.fsync(f.fileno())
+            end = f.tell()
+        if end - len(lines) == self._log_offset:
+            # Между нашим последним чтением и записью журнал никто не дописывал
+            self._log_offset = end
+            self._log_signature = self._file_signature(self.conversations_log)
+        else:
+            # Перед нашими строками есть чужие: дочитаем их позже, а свои пропустим
+            self._own_unread.update((c.get("id"), c.get("created_at")) for c in conversations)
+
+    def _mark_dirty(self):
+        """Учесть изменение в режиме отложенной записи"""
+        self._mutations += 1
+        if self._mutations >= self.flush_max_mutations:
+            self._wakeup.notify()
+
+    def _flush_loop(self):
+        """Фоновый поток: групповая запись накопленных изменений"""
+        with self._wakeup:
+            while not self._closed:
+                self._wakeup.wait(self.flush_interval)
+                self.flush()
+
+    @synchronized
+    def flush(self):
+        """Записать на диск все отложенные изменения"""
+        if self._pending_conversations:
+            pending, self._pending_conversations = self._pending_conversations, []
+            self._append_conversations(pending)
+        if self._dirty:
+            dirty, self._dirty = self._dirty, set()
+            self._write_files(dirty)
+        self._publish_pending()
+        self._mutations = 0
+
+    def _publish_pending(self):
+        """Опубликовать накопленные события — только после того, как их данные записаны"""
+        if self._pending_changes:
+            # Подписчик, получив событие, уже видит изменение на диске
+            pending, self._pending_changes = self._pending_changes, []
+            self._publish_changes(pending)
+
+    def close(self):
+        """Остановить фоновую запись и сбросить всё на диск"""
+        with self._lock:
+            self._closed = True
+            if self._flusher is not None:
+                self._wakeup.notify()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self.flush()
+
+    @synchronized
+    def save_data(self, *collections: str):
+        """Сохранить изменённые коллекции (без аргументов — все загруженные).
+
+        Переписывается только файл, где лежит коллекция; диалоги пишутся в свой журнал.
+        """
+        if not collections:
+            collections = INDEXED_COLLECTIONS
+        files = {
+            collection if collection in SPLIT_COLLECTIONS else "main"
+            for collection in collections
+            if collection not in SPLIT_COLLECTIONS or collection in self._loaded
+        }
+        if self._tx_depth:
+            self._tx_files |= files
+            return
+        if self.write_behind and not self._closed:
+            self._dirty |= files
+            self._mark_dirty()
+            return
+        self._write_files(files)
+        self._publish_pending()
+
+    def _dump(self, content) -> str:
+        if self.compact:
+            return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=to_plain)
+        return json.dumps(content, ensure_ascii=False, indent=2, default=to_plain)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"Хранилище {self.data_file} открыто только для чтения")
+
+    def _write_files(self, files):
+        self._check_writable()
+        # Основной файл пишется последним: пока он не переписан, старые данные
+        # в нём остаются запасным источником для ещё не созданных файлов коллекций
+        for key in sorted(files, key=lambda k: k == "main"):
+            if key == "main":
+                skip = set(SPLIT_COLLECTIONS) | {"conversations"}
+                content = {k: v for k, v in self._data.items() if k not in skip}
+            else:
+                content = {"sequence": self._data["sequences"].get(key, 0),
+                           "display_fields": DISPLAY_FIELDS_VERSION, "records": self._data[key]}
+            atomic_write_text(self._path(key), self._dump(content))
+            # Собственная запись не должна вызывать повторного чтения при reload()
+            self._signatures[key] = self._file_signature(self._path(key))
+
+    @synchronized
+    def reload(self):
+        """Перечитать с диска то, что изменил другой процесс.
+
+        Проверяется stat() каждого загруженного файла, перечитываются только
+        изменившиеся. Сам reload() ничего не записывает: файл, в котором у нас
+        есть несохранённые изменения, не перечитывается — его всё равно
+        перезапишет ближайший flush().
+        """
+        unsaved = self._dirty | self._tx_files
+        try:
+            self._reread_files(key for key in ("main", *SPLIT_COLLECTIONS)
+                               if key not in unsaved and self._changed(key))
+        except ValueError:
+            # Оставляем данные в памяти; попробуем снова при следующем изменении файла
+            pass
+        if "conversations" in self._loaded:
+            self._reload_conversations()
+
+    def _reload_conversations(self):
+        """Дочитать журнал диалогов (или прочитать заново, если его заменили)"""
+        log_signature = self._file_signature(self.conversations_log)
+        if log_signature == self._log_signature:
+            return
+        if (log_signature is None or self._log_signature is None
+                or log_signature[2] != self._log_signature[2] or log_signature[1] < self._log_offset):
+            # Журнал заменили или обрезали (например, скриптами очистки) — читаем целиком;
+            # диалоги, которые ещё ждут записи в журнал, остаются в памяти
+            self._data["conversations"] = (self._load_conversations([])
+                                           + self._pending_conversations + self._tx_conversations)
+            self._index_conversations()
+            return
+        for conversation in self._read_conversations_tail():
+            self._data["conversations"].append(conversation)
+            self._index_conversation(conversation)
+            self._note_appended("conversations")
     
+    def _reread_files(self, keys):
+        """Заменить данные в памяти содержимым файлов ("main" или имя коллекции)"""
+        for key in keys:
+            if key == "main":
+                main = self._load_main()
+                for name, value in main.items():
+                    if name not in SPLIT_COLLECTIONS and name not in ("conversations", "sequences"):
+                        self._data[name] = value
+                for collection, record_id in main["sequences"].items():
+                    self._observe_id(collection, record_id)
+                for collection in ("courses", "teachers", "employees"):
+                    self._index_collection(collection)
+            elif key in self._loaded:
+                self._data[key] = self._load_split(key)
+                self._index_collection(key)
+
+    # ===== Транзакции =====
+    def begin(self):
+        """Начать транзакцию: изменения попадут на диск одной записью при commit().
+
+        До конца транзакции хранилище заблокировано для других потоков.
+        Вложенная транзакция становится частью внешней.
+        """
+        self._lock.acquire()
+        if not self._tx_depth:
+            try:
+                # Всё, что было до транзакции, уже на диске — к этому состоянию вернёт rollback()
+                self.flush()
+            except BaseException:
+                self._lock.release()
+                raise
+            self._tx_failed = False
+        self._tx_depth += 1
+
+    def commit(self):
+        """Завершить транзакцию и записать её изменения"""
+        if not self._tx_depth:
+            raise RuntimeError("Транзакция не начата")
+        try:
+            self._tx_depth -= 1
+            if self._tx_depth:
+                return
+            if self._tx_failed:
+                self._discard_transaction()
+                raise RuntimeError("Транзакция отменена: во вложенном блоке был rollback()")
+            files, self._tx_files = self._tx_files, set()
+            conversations, self._tx_conversations = self._tx_conversations, []
+            changes, self._tx_changes = self._tx_changes, []
+            try:
+                if conversations:
+                    self._append_conversations(conversations)
+                self._write_files(files)
+            except BaseException:
+                # Данные в памяти остаются; незаписанные файлы сохранит следующий flush()
+                self._dirty |= files
+                self._pending_changes.extend(changes)
+                raise
+            if changes:
+                self._publish_changes(changes)
+        finally:
+            self._lock.release()
+
+    def rollback(self):
+        """Отменить транзакцию: изменённые коллекции перечитываются с диска"""
+        if not self._tx_depth:
+            raise RuntimeError("Транзакция не начата")
+        try:
+            self._tx_depth -= 1
+            if self._tx_depth:
+                # Часть изменений отменить нельзя — отменится вся внешняя транзакция
+                self._tx_failed = True
+                return
+            self._discard_transaction()
+        finally:
+            self._lock.release()
+
+    def _discard_transaction(self):
+        files, self._tx_files = self._tx_files, set()
+        conversations, self._tx_conversations = self._tx_conversations, []
+        self._tx_changes = []
+        if conversations:
+            dropped = {id(c) for c in conversations}
+            self._data["conversations"] = [c for c in self._data["conversations"] if id(c) not in dropped]
+            self._index_conversations()
+        # Выданные в транзакции id не возвращаются: счётчики только растут
+        self._reread_files(sorted(files, key=lambda k: k != "main"))
+
+    @contextmanager
+    def transaction(self):
+        """Группа изменений: with crm.transaction(): ...
+
+        При выходе из блока всё записывается одной записью на файл,
+        при исключении изменения отменяются.
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    batch = transaction
+
+    # ===== Журнал изменений =====
+    def subscribe(self, callback):
+        """Подписаться на изменения: callback(event) вызывается, когда событие записано в журнал.
+
+        Вызов идёт под блокировкой хранилища (в режиме отложенной записи — из фонового
+        потока), поэтому подписчик должен быстро передать событие дальше.
+        """
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def read_changes(self, since_seq: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        """События журнала изменений с seq > since_seq по возрастанию seq"""
+        start, start_seq = 0, 0
+        signature = self._file_signature(self.changes_log)
+        cursor = self._changes_cursor
+        # Продолжаем с места прошлого чтения, если файл тот же и читатель не отстал
+        if (cursor and signature and cursor[0] == signature[2]
+                and cursor[1] <= signature[1] and cursor[2] <= since_seq):
+            start, start_seq = cursor[1], cursor[2]
+        events, offset, last_seq = read_changes_log(self.changes_log, since_seq, limit, start, start_seq)
+        if signature:
+            self._changes_cursor = (signature[2], offset, last_seq)
+        return events
+
+    def last_change_seq(self) -> int:
+        """seq последнего события в журнале; следующий read_changes(seq) продолжит с конца файла"""
+        signature = self._file_signature(self.changes_log)
+        if signature is None:
+            return 0
+        with open(self.changes_log, 'rb') as f:
+            seq = _last_change_seq(f)
+            # Позиция после последней целой строки — туда встаёт курсор чтения
+            end = f.seek(0, os.SEEK_END)
+            start = max(end - 65536, 0)
+            f.seek(start)
+            tail = f.read(end - start)
+        newline = tail.rfind(b"\n")
+        if newline >= 0:
+            self._changes_cursor = (signature[2], start + newline + 1, seq)
+        return seq
+
+    def _emit(self, event: Dict):
+        """Запомнить событие изменения; в журнал и подписчикам оно уходит после записи данных:
+        при commit(), flush() или сразу после сохранения (save_data, дописывание диалога)"""
+        if self._tx_depth:
+            self._tx_changes.append(event)
+        else:
+            self._pending_changes.append(event)
+
+    def _publish_changes(self, events: List[Dict]):
+        self._check_writable()
+        for event in append_changes(self.changes_log, events):
+            for callback in list(self._subscribers):
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception("Ошибка в подписчике на изменения CRM")
+
+    @synchronized
     def add_user(self, user_data: Dict) -> int:
         """Добавить пользователя"""
-        # Генерируем уникальный ID - находим максимальный существующий ID и добавляем 1
-        existing_ids = [user.get("id", 0) for user in self.data["users"]]
-        user_id = max(existing_ids, default=0) + 1
+        user_id = self._next_id("users")
         
         user_data["id"] = user_id
         user_data["created_at"] = datetime.now().isoformat()
-        user_data["last_activity"] = datetime.now().isoformat()
-        self.data["users"].append(user_data)
-        self.data["statistics"]["total_users"] = len(self.data["users"])
-        self.save_data()
+        user_data["last_activity"] = user_data["created_at"]
+        user = MODELS["users"].from_dict(user_data)
+        self._data["users"].append(user)
+        self._index_record("users", user)
+        self._emit(change_event("user_added", "users", user_id, user))
+        self.save_data("users")
         return user_id
     
     def get_user(self, telegram_id: int) -> Optional[Dict]:
         """Получить пользователя по Telegram ID"""
-        for user in self.data["users"]:
-            if user.get("telegram_id") == telegram_id:
-                return user
-        return None
+        return self._users_by_telegram_id.get(telegram_id)
+    
+    def get_user_by_id(self, user_id: int) -> Optional[Dict]:
+        """Получить пользователя по ID в CRM"""
+        return self._by_id["users"].get(user_id)
     
+    @synchronized
     def update_user_activity(self, telegram_id: int):
         """Обновить активность пользователя"""
         user = self.get_user(telegram_id)
         if user:
-            user["last_activity"] = datetime.now().isoformat()
-            self.save_data()
+            # Пользователь переезжает в конец упорядоченного индекса активности
+            self._unindex_activity(user)
+            user.set_timestamp("last_activity", now_ts())
+            self._index_activity(user)
+            # В журнал изменений не пишется: событие на каждое сообщение бота никому не нужно
+            self.save_data("users")
     
+    @synchronized
     def add_conversation(self, telegram_id: int, message: str, response: str):
         """Добавить диалог"""
-        conversation = {
-            "id": len(self.data["conversations"]) + 1,
+        self._require("conversations")
+        conversation = Conversation({
+            "id": self._next_id("conversations"),
             "telegram_id": telegram_id,
-            "message": message,
-            "response": response,
-            "created_at": datetime.now().isoformat()
-        }
-        self.data["conversations"].append(conversation)
-        
-        # Инициализируем статистику если её нет
-        if "statistics" not in self.data:
-            self.data["statistics"] = {
-                "total_users": len(self.data.get("users", [])),
-                "total_conversations": len(self.data.get("conversations", [])),
-                "total_bookings": len(self.data.get("bookings", [])),
-                "active_courses": len([c for c in self.data.get("courses", []) if c.get("is_active", True)]),
-                "active_teachers": len([t for t in self.data.get("teachers", []) if t.get("is_active", True)])
-            }
-        
-        self.data["statistics"]["total_conversations"] = len(self.data["conversations"])
-        self.save_data()
+            "message": self._shared_text(message),
+            "response": self._shared_text(response),
+        })
+        conversation.set_timestamp("created_at", now_ts())
+        self._data["conversations"].append(conversation)
+        self._index_conversation(conversation)
+        self._note_appended("conversations")
+        self._emit(change_event("conversation_added", "conversations", conversation["id"], {"telegram_id": telegram_id}))
+
+        # Только дописываем строку в журнал — стоимость не зависит от объёма истории
+        if self._tx_depth:
+            self._tx_conversations.append(conversation)
+        elif self.write_behind and not self._closed:
+            self._pending_conversations.append(conversation)
+            self._mark_dirty()
+        else:
+            self._append_conversations([conversation])
+            self._publish_pending()
     
+    @synchronized
     def add_booking(self, booking_data: Dict) -> int:
         """Добавить запись на курс"""
-        booking_id = len(self.data["bookings"]) + 1
+        self._require("bookings")
+        booking_id = self._next_id("bookings")
         booking_data["id"] = booking_id
         booking_data["created_at"] = datetime.now().isoformat()
         booking_data["status"] = "pending"
-        self.data["bookings"].append(booking_data)
-        
-        # Инициализируем статистику если её нет
-        if "statistics" not in self.data:
-            self.data["statistics"] = {
-                "total_users": len(self.data.get("users", [])),
-                "total_conversations": len(self.data.get("conversations", [])),
-                "total_bookings": len(self.data.get("bookings", [])),
-                "active_courses": len([c for c in self.data.get("courses", []) if c.get("is_active", True)]),
-                "active_teachers": len([t for t in self.data.get("teachers", []) if t.get("is_active", True)])
-            }
-        
-        self.data["statistics"]["total_bookings"] = len(self.data["bookings"])
-        self.save_data()
+        booking = MODELS["bookings"].from_dict(booking_data)
+        self._data["bookings"].append(booking)
+        self._index_record("bookings", booking)
+        self._emit(change_event("booking_added", "bookings", booking_id, booking))
+        self._note_appended("bookings")
+
+        self.save_data("bookings")
         return booking_id
     
     def get_courses(self) -> List[Dict]:
         """Получить все курсы"""
-        courses = []
-        for course in self.data["courses"]:
-            if course.get("is_active", True):
-                # Нормализуем структуру курса
-                normalized_course = {
-                    "id": course.get("id"),
-                    "name": course.get("name"),
-                    "description": course.get("description"),
-                    "duration": course.get("duration", f"{course.get('duration_months', 2)} месяца"),
-                    "duration_months": course.get("duration_months", None),
-                    "level": course.get("level"),
-                    "status": course.get("status"),
-                    "language": course.get("language", "Турецкий"),
-                    "price": course.get("price", "Уточняется на консультации"),
-                    "is_active": course.get("is_active", True),
-                    # Новые поля расписания (необязательные)
-                    "days": course.get("days", []),
-                    "time_from": course.get("time_from"),
-                    "time_to": course.get("time_to"),
-                    "teacher_id": course.get("teacher_id"),
-                    "teacher_name": course.get("teacher_name")
-                }
-                courses.append(normalized_course)
-        return courses
+        return [normalize_course(course) for course in self._data["courses"] if course.get("is_active", True)]
     
     def get_course(self, course_id: int) -> Optional[Dict]:
         """Получить курс по ID"""
-        for course in self.data["courses"]:
-            if course["id"] == course_id:
-                # Нормализуем структуру курса
-                return {
-                    "id": course.get("id"),
-                    "name": course.get("name"),
-                    "description": course.get("description"),
-                    "duration": course.get("duration", f"{course.get('duration_months', 2)} месяца"),
-                    "duration_months": course.get("duration_months", None),
-                    "level": course.get("level"),
-                    "status": course.get("status"),
-                    "language": course.get("language", "Турецкий"),
-                    "price": course.get("price", "Уточняется на консультации"),
-                    "is_active": course.get("is_active", True),
-                    "days": course.get("days", []),
-                    "time_from": course.get("time_from"),
-                    "time_to": course.get("time_to"),
-                    "teacher_id": course.get("teacher_id"),
-                    "teacher_name": course.get("teacher_name")
-                }
-        return None
+        course = self._by_id["courses"].get(course_id)
+        return normalize_course(course) if course else None
     
     def get_teachers(self) -> List[Dict]:
         """Получить всех преподавателей"""
-        teachers = []
-        for teacher in self.data["teachers"]:
-            if teacher.get("is_active", True):
-                # Нормализуем структуру преподавателя
-                # Нормализуем языки: допускаем как список, так и строку
-                raw_languages = teacher.get("languages")
-                if isinstance(raw_languages, list):
-                    languages = raw_languages
-                elif isinstance(raw_languages, str) and raw_languages.strip():
-                    # Разбиваем по запятой, игнорируя пробелы
-                    languages = [lng.strip() for lng in raw_languages.split(",") if lng.strip()]
-                else:
-                    languages = ["турецкий", "русский"]
-
-                normalized_teacher = {
-                    "id": teacher.get("id"),
-                    "name": teacher.get("name"),
-                    "specialization": teacher.get("specialization"),
-                    "experience": f"{teacher.get('experience_years', 5)} лет",
-                    "languages": languages,
-                    "is_active": teacher.get("is_active", True)
-                }
-                teachers.append(normalized_teacher)
-        return teachers
+        return [normalize_teacher(teacher) for teacher in self._data["teachers"] if teacher.get("is_active", True)]
     
+    def get_teacher(self, teacher_id: int) -> Optional[Dict]:
+        """Получить преподавателя по ID (исходная запись, без нормализации)"""
+        return self._by_id["teachers"].get(teacher_id)
+    
+    @synchronized
     def get_statistics(self) -> Dict:
-        """Получить статистику (пересчёт при каждом вызове)"""
+        """Получить статистику.
+
+        Счётчики обновляются при каждом изменении данных, поэтому здесь нет
+        пересчёта — только проверка, не изменил ли файлы другой процесс.
+        """
+        for collection in LAZY_COLLECTIONS:
+            self._require(collection)
         try:
-            # перечитываем свежие данные с диска, чтобы цифры совпадали со списками
-            self.data = self.load_data()
+            # подхватываем изменения с диска, чтобы цифры совпадали со списками
+            self.reload()
         except Exception:
             pass
-        stats = self.data.get("statistics", {}) or {}
-        stats["total_users"] = len(self.data.get("users", []))
-        stats["total_conversations"] = len(self.data.get("conversations", []))
-        stats["total_bookings"] = len(self.data.get("bookings", []))
-        stats["active_courses"] = len([c for c in self.data.get("courses", []) if c.get("is_active", True)])
-        stats["active_teachers"] = len([t for t in self.data.get("teachers", []) if t.get("is_active", True)])
-        self.data["statistics"] = stats
-        return stats
+        return statistics_view(self._stats)
     
+    @synchronized
     def get_recent_conversations(self, user_id: int = None, limit: int = 10) -> List[Dict]:
         """Получить последние диалоги"""
-        conversations = self.data["conversations"]
+        self._require("conversations")
+        conversations = self._data["conversations"]
         
         # Фильтруем по пользователю если указан
         if user_id:
+            recent = self._recent_by_user.get(user_id, ())
+            if limit <= RECENT_CONVERSATIONS_PER_USER or len(recent) < RECENT_CONVERSATIONS_PER_USER:
+                # Буфер хранит диалоги в порядке добавления — берём с конца, O(limit)
+                return list(reversed(recent))[:limit]
             conversations = [conv for conv in conversations if conv.get("telegram_id") == user_id]
+            return heapq.nlargest(limit, conversations, key=lambda x: x.timestamp("created_at"))
         
-        return sorted(conversations, key=lambda x: x["created_at"], reverse=True)[:limit]
+        return self._latest("conversations", limit)
+    
+    def get_user_metrics(self, telegram_id: int) -> Dict:
+        """Число диалогов, записей и разных курсов пользователя (счётчики, без обхода коллекций)"""
+        for collection in LAZY_COLLECTIONS:
+            self._require(collection)
+        return {
+            "telegram_id": telegram_id,
+            "conversations_count": self._conversations_by_user.get(telegram_id, 0),
+            "bookings_count": self._bookings_by_user.get(telegram_id, 0),
+            "courses_count": len(self._courses_by_user.get(telegram_id, ())),
+        }
+
+    def get_users_metrics(self, telegram_ids: List[int]) -> List[Dict]:
+        """get_user_metrics для списка пользователей одним вызовом (карточки на странице)"""
+        return [self.get_user_metrics(telegram_id) for telegram_id in telegram_ids]
+
+    def get_all_user_metrics(self) -> List[Dict]:
+        """get_user_metrics для всех, у кого есть диалоги или записи"""
+        for collection in LAZY_COLLECTIONS:
+            self._require(collection)
+        telegram_ids = self._conversations_by_user.keys() | self._bookings_by_user.keys()
+        return [self.get_user_metrics(telegram_id) for telegram_id in telegram_ids]
+
+    @synchronized
+    def get_user_conversations(self, telegram_id: int, since_id: Optional[int] = None,
+                               since_ts: Optional[str] = None) -> List[Dict]:
+        """Получить переписку пользователя по времени (по возрастанию).
+
+        since_id / since_ts — только диалоги новее курсора (дозагрузка в открытом чате).
+        """
+        self._require("conversations")
+        cutoff = parse_ts(since_ts) if since_ts else None
+        if since_ts and cutoff is None:
+            raise ValueError(f"Неверная дата: {since_ts}")
+
+        def is_new(conversation) -> bool:
+            return ((since_id is None or (conversation.get("id") or 0) > since_id)
+                    and (cutoff is None or conversation.timestamp("created_at") > cutoff))
+
+        recent = self._recent_by_user.get(telegram_id, ())
+        if (since_id is not None or cutoff is not None) and (
+                len(recent) < RECENT_CONVERSATIONS_PER_USER or not is_new(recent[0])):
+            # Все новые диалоги в буфере последних — история не просматривается
+            conversations = [c for c in recent if is_new(c)]
+        else:
+            conversations = [c for c in self._data["conversations"]
+                             if c.get("telegram_id") == telegram_id and is_new(c)]
+        return sorted(conversations, key=lambda x: x.timestamp("created_at"))
+    
+    def get_user_bookings(self, telegram_id: int) -> List[Dict]:
+        """Получить заявки пользователя (user_id в заявке — это telegram_id)"""
+        self._require("bookings")
+        return [b for b in self._data["bookings"] if b.get("user_id") == telegram_id]
     
     def get_recent_bookings(self, limit: int = 10) -> List[Dict]:
         """Получить последние записи"""
-        return sorted(self.data["bookings"], key=lambda x: x["created_at"], reverse=True)[:limit]
+        return self._latest("bookings", limit)
     
+    @synchronized
     def get_users_by_activity(self, days: int = 7) -> List[Dict]:
-        """Получить активных пользователей за последние N дней"""
-        cutoff_date = datetime.now() - timedelta(days=days)
-        active_users = []
-        
-        for user in self.data["users"]:
-            last_activity = datetime.fromisoformat(user.get("last_activity", "2020-01-01"))
-            if last_activity > cutoff_date:
-                active_users.append(user)
-        
-        return active_users
+        """Получить активных пользователей за последние N дней (сначала самые недавние).
+
+        Бинарный поиск по индексу активности: O(log n + k) вместо обхода всех пользователей.
+        """
+        cutoff = ts_from_datetime(datetime.now() - timedelta(days=days))
+        start = bisect.bisect_right(self._activity_ts, cutoff)
+        return self._activity_users[:start - 1:-1] if start else self._activity_users[::-1]
+
+    def query_users(self, status: Optional[str] = None, source: Optional[str] = None,
+                    date_from: Optional[str] = None, date_to: Optional[str] = None, q: Optional[str] = None,
+                    sort: str = "created_at", descending: bool = True, offset: int = 0, limit: int = 50) -> Dict:
+        """Страница пользователей: {"items", "total", "offset", "limit"}.
+
+        status — kanban_status, source — источник, date_from/date_to — период по created_at,
+        q — подстрока имени, username, телефона или точный telegram_id.
+        """
+        return self._query("users", status, source, date_from, date_to, q, sort, descending, offset, limit)
+
+    def query_bookings(self, status: Optional[str] = None, date_from: Optional[str] = None,
+                       date_to: Optional[str] = None, q: Optional[str] = None, sort: str = "created_at",
+                       descending: bool = True, offset: int = 0, limit: int = 50) -> Dict:
+        """Страница записей на курсы, фильтры как у query_users"""
+        return self._query("bookings", status, None, date_from, date_to, q, sort, descending, offset, limit)
+
+    def _query(self, collection: str, status, source, date_from, date_to, q, sort: str,
+               descending: bool, offset: int, limit: int) -> Dict:
+        self._require(collection)
+        if sort not in QUERY_SORT_KEYS[collection]:
+            raise ValueError(f"Сортировка по {sort} не поддерживается")
+        offset, limit = max(offset, 0), max(limit, 0)
+        lower, upper = query_date_range(date_from, date_to)
+        conditions = []
+        if source:
+            conditions.append(lambda r: (r.get("source") or "unknown") == source)
+        if lower:
+            lower_ts = parse_ts(lower)
+            conditions.append(lambda r: r.timestamp("created_at") >= lower_ts)
+        if upper:
+            upper_ts = parse_ts(upper)
+            conditions.append(lambda r: r.timestamp("created_at") < upper_ts)
+        if q and q.strip():
+            needle = q.strip().casefold()
+            fields = QUERY_TEXT_FIELDS[collection]
+            telegram_field = QUERY_TELEGRAM_FIELDS[collection]
+            conditions.append(lambda r: str(r.get(telegram_field)) == needle
+                              or any(needle in str(r.get(f) or "").casefold() for f in fields))
+
+        with self._lock:
+            if status:
+                candidates = list(self._by_status[collection].get(status, {}).values())
+            elif not conditions and sort == "last_activity":
+                return self._ordered_page(self._activity_users, descending, offset, limit)
+            elif not conditions and sort == "created_at" and self._time_ordered.get(collection):
+                return self._ordered_page(self._data[collection], descending, offset, limit)
+            else:
+                candidates = self._data[collection]
+            matched = [r for r in candidates if all(c(r) for c in conditions)] if conditions else candidates
+            # При равном времени порядок задаёт id — границы страниц не плавают
+            key = (lambda r: r.get("id") or 0) if sort == "id" else (lambda r: (r.timestamp(sort), r.get("id") or 0))
+            # Частичная сортировка: только offset + limit первых записей
+            select = heapq.nlargest if descending else heapq.nsmallest
+            return query_page(select(offset + limit, matched, key=key)[offset:], len(matched), offset, limit)
+
+    @staticmethod
+    def _ordered_page(ordered: List[Dict], descending: bool, offset: int, limit: int) -> Dict:
+        """Страница из списка, уже упорядоченного по возрастанию ключа — срез без сортировки"""
+        total = len(ordered)
+        if descending:
+            end = max(total - offset, 0)
+            items = ordered[max(end - limit, 0):end][::-1]
+        else:
+            items = ordered[offset:offset + limit]
+        return query_page(items, total, offset, limit)
+
+    @synchronized
+    def add_course(self, course_data: Dict) -> int:
+        """Добавить курс"""
+        course_id = self._next_id("courses")
+        course_data["id"] = course_id
+        course_data.setdefault("is_active", True)
+        course_data["created_at"] = datetime.now().isoformat()
+        course = MODELS["courses"].from_dict(course_data)
+        self._data["courses"].append(course)
+        self._index_record("courses", course)
+        self._emit(change_event("course_added", "courses", course_id, course))
+        self.save_data("courses")
+        return course_id
+    
+    @synchronized
+    def add_teacher(self, teacher_data: Dict) -> int:
+        """Добавить преподавателя"""
+        teacher_id = self._next_id("teachers")
+        teacher_data["id"] = teacher_id
+        teacher_data.setdefault("is_active", True)
+        teacher_data["created_at"] = datetime.now().isoformat()
+        teacher = MODELS["teachers"].from_dict(teacher_data)
+        self._data["teachers"].append(teacher)
+        self._index_record("teachers", teacher)
+        self._emit(change_event("teacher_added", "teachers", teacher_id, teacher))
+        self.save_data("teachers")
+        return teacher_id
     
+    @synchronized
     def update_course(self, course_id: int, course_data: Dict) -> bool:
         """Обновить курс"""
-        for i, course in enumerate(self.data["courses"]):
-            if course["id"] == course_id:
-                # Сохраняем расписание и преподавателя
-                self.data["courses"][i].update(course_data)
-                # Гарантируем наличие полей в хранилище
-                if "days" in course_data and course_data["days"] is None:
-                    self.data["courses"][i]["days"] = []
-                if "time_from" in course_data and course_data["time_from"] is None:
-                    self.data["courses"][i]["time_from"] = None
-                if "time_to" in course_data and course_data["time_to"] is None:
-                    self.data["courses"][i]["time_to"] = None
-                self.save_data()
-                return True
-        return False
+        course = self._by_id["courses"].get(course_id)
+        if course is None:
+            return False
+        # Сохраняем расписание и преподавателя
+        self._update_record("courses", course, course_data)
+        # Гарантируем наличие полей в хранилище
+        if "days" in course_data and course_data["days"] is None:
+            course["days"] = []
+        self.save_data("courses")
+        return True
     
+    @synchronized
     def update_teacher(self, teacher_id: int, teacher_data: Dict) -> bool:
         """Обновить преподавателя"""
-        for i, teacher in enumerate(self.data["teachers"]):
-            if teacher["id"] == teacher_id:
-                self.data["teachers"][i].update(teacher_data)
-                self.save_data()
-                return True
-        return False
+        teacher = self._by_id["teachers"].get(teacher_id)
+        if teacher is None:
+            return False
+        self._update_record("teachers", teacher, teacher_data)
+        self.save_data("teachers")
+        return True
     
+    @synchronized
     def update_user(self, user_id: int, user_data: Dict) -> bool:
         """Обновить пользователя"""
-        for i, user in enumerate(self.data["users"]):
-            if user["id"] == user_id:
-                self.data["users"][i].update(user_data)
-                self.save_data()
-                return True
-        return False
+        user = self._by_id["users"].get(user_id)
+        if user is None:
+            return False
+        self._update_record("users", user, user_data)
+        self.save_data("users")
+        return True
     
+    @synchronized
     def delete_course(self, course_id: int) -> bool:
         """Удалить курс"""
-        for i, course in enumerate(self.data["courses"]):
-            if course["id"] == course_id:
-                del self.data["courses"][i]
-                self.save_data()
-                return True
-        return False
+        course = self._by_id["courses"].get(course_id)
+        if course is None:
+            return False
+        self._remove_record("courses", course)
+        self.save_data("courses")
+        return True
     
+    @synchronized
     def delete_teacher(self, teacher_id: int) -> bool:
         """Удалить преподавателя"""
-        for i, teacher in enumerate(self.data["teachers"]):
-            if teacher["id"] == teacher_id:
-                del self.data["teachers"][i]
-                self.save_data()
-                return True
-        return False
+        teacher = self._by_id["teachers"].get(teacher_id)
+        if teacher is None:
+            return False
+        self._remove_record("teachers", teacher)
+        self.save_data("teachers")
+        return True
     
+    @synchronized
     def delete_user(self, user_id: int) -> bool:
         """Удалить пользователя"""
-        for i, user in enumerate(self.data["users"]):
-            if user["id"] == user_id:
-                del self.data["users"][i]
-                # Обновляем статистику
-                self.data["statistics"]["total_users"] = len(self.data["users"])
-                self.save_data()
-                return True
-        return False
+        user = self._by_id["users"].get(user_id)
+        if user is None:
+            return False
+        self._remove_record("users", user)
+        self.save_data("users")
+        return True
     
     def get_booking(self, booking_id: int) -> Optional[Dict]:
         """Получить запись по ID"""
-        for booking in self.data["bookings"]:
-            if booking["id"] == booking_id:
-                return booking
-        return None
+        self._require("bookings")
+        return self._by_id["bookings"].get(booking_id)
     
+    @synchronized
     def update_booking(self, booking_id: int, booking_data: Dict) -> bool:
         """Обновить запись"""
-        for i, booking in enumerate(self.data["bookings"]):
-            if booking["id"] == booking_id:
-                self.data["bookings"][i].update(booking_data)
-                self.save_data()
-                return True
-        return False
+        self._require("bookings")
+        booking = self._by_id["bookings"].get(booking_id)
+        if booking is None:
+            return False
+        self._update_record("bookings", booking, booking_data)
+        self.save_data("bookings")
+        return True
     
+    @synchronized
     def delete_booking(self, booking_id: int) -> bool:
         """Удалить запись"""
-        for i, booking in enumerate(self.data["bookings"]):
-            if booking["id"] == booking_id:
-                del self.data["bookings"][i]
-                self.save_data()
-                return True
-        return False
+        self._require("bookings")
+        booking = self._by_id["bookings"].get(booking_id)
+        if booking is None:
+            return False
+        self._remove_record("bookings", booking)
+        self.save_data("bookings")
+        return True
     
+    @synchronized
     def update_booking_status(self, booking_id: int, status: str) -> bool:
         """Обновить статус записи"""
-        for i, booking in enumerate(self.data["bookings"]):
-            if booking["id"] == booking_id:
-                self.data["bookings"][i]["status"] = status
-                self.data["bookings"][i]["updated_at"] = datetime.now().isoformat()
-                self.save_data()
-                return True
-        return False
+        self._require("bookings")
+        booking = self._by_id["bookings"].get(booking_id)
+        if booking is None:
+            return False
+        self._update_record("bookings", booking, {"status": status, "updated_at": datetime.now().isoformat()})
+        self.save_data("bookings")
+        return True
 
     def get_all_users(self):
         """Получить всех пользователей"""
-        return self.data.get("users", [])
+        return self._data.get("users", [])
 
     def get_all_bookings(self):
         """Получить все записи"""
-        return self.data.get("bookings", [])
+        self._require("bookings")
+        return self._data.get("bookings", [])
 
     def get_all_courses(self):
         """Получить все курсы"""
-        return self.data.get("courses", [])
+        return self._data.get("courses", [])
 
     def get_all_teachers(self):
         """Получить всех преподавателей"""
-        return self.data.get("teachers", [])
+        return self._data.get("teachers", [])
 
     def get_all_employees(self):
         """Получить всех сотрудников"""
-        return self.data.get("employees", [])
+        return self._data.get("employees", [])
+
+    def get_employee_by_username(self, username: str) -> Optional[Dict]:
+        """Получить сотрудника по логину"""
+        return self._employees_by_username.get(username)
+
+    def get_records_chunk(self, collection: str, offset: int = 0, limit: int = 1000) -> List[Dict]:
+        """Часть коллекции в порядке хранения — выгрузка читает коллекцию кусками, без полной копии"""
+        if collection not in MODELS:
+            raise ValueError(f"Неизвестная коллекция: {collection}")
+        if collection in LAZY_COLLECTIONS:
+            self._require(collection)
+        with self._lock:
+            return self._data.get(collection, [])[max(offset, 0):max(offset, 0) + max(limit, 0)]
+
+    def get_all_conversations(self):
+        """Получить все диалоги"""
+        self._require("conversations")
+        return self._data.get("conversations", [])
 
+    # ===== Архив =====
+    @synchronized
+    def archive(self, max_age_days: int = ARCHIVE_AFTER_DAYS) -> Dict:
+        """Перенести диалоги и закрытые записи старше max_age_days в архив,
+        удалить из журнала изменений события старше CHANGES_KEEP_DAYS.
+
+        Сначала данные дописываются в архив, потом удаляются из рабочих файлов:
+        при сбое между шагами запись окажется в двух местах, но не потеряется.
+        """
+        if self._tx_depth:
+            raise RuntimeError("Архивация внутри транзакции не поддерживается")
+        self.flush()
+        for collection in LAZY_COLLECTIONS:
+            self._require(collection)
+        cutoff = ts_from_datetime(datetime.now() - timedelta(days=max_age_days))
+
+        def is_old(record) -> bool:
+            return 0 < record.timestamp("created_at") < cutoff
+
+        # Журнал заблокирован от чтения хвоста до конца переписывания: диалоги,
+        # которые другие процессы дописали после нашей загрузки, не потеряются
+        with locked_file(self.conversations_lock):
+            self._reload_conversations()
+            old_conversations = [c for c in self._data["conversations"] if is_old(c)]
+            if old_conversations:
+                append_archive(self.archive_dir, "conversations", old_conversations)
+                self._data["conversations"] = [c for c in self._data["conversations"] if not is_old(c)]
+                self._compact_conversations_log()
+                self._index_conversations()
+        old_bookings = [b for b in self._data["bookings"]
+                        if is_old(b) and str(b.get("status", "")).lower() in CLOSED_BOOKING_STATUSES]
+        if old_bookings:
+            append_archive(self.archive_dir, "bookings", old_bookings)
+            archived = {id(b) for b in old_bookings}
+            self._data["bookings"] = [b for b in self._data["bookings"] if id(b) not in archived]
+            self._index_collection("bookings")
+            self.save_data("bookings")
+        if old_conversations or old_bookings:
+            # Счётчики id сохраняются в основном файле, чтобы id архивных записей не выдавались снова
+            self.save_data("sequences")
+            self._emit(change_event("archived", None, None,
+                                    {"conversations": len(old_conversations), "bookings": len(old_bookings)}))
+            self.flush()
+        # Журнал изменений не копится вечно: старые события никому не нужны
+        keep_after = (datetime.now() - timedelta(days=CHANGES_KEEP_DAYS)).isoformat()
+        trimmed = trim_changes(self.changes_log, keep_after)
+        return {"conversations": len(old_conversations), "bookings": len(old_bookings), "changes": trimmed}
+
+    def _compact_conversations_log(self):
+        """Переписать журнал диалогов только с оставшимися записями"""
+        # Счётчик id диалогов в основном файле отстаёт от журнала (его пишут только при изменении
+        # справочников) — сохраняем его до того, как последние id уйдут из журнала в архив
+        self._write_files({"main"})
+        atomic_write_text(self.conversations_log, self._pack_conversations(self._data["conversations"]))
+        # Другие процессы увидят новый inode и перечитают журнал целиком
+        self._log_signature = self._file_signature(self.conversations_log)
+        self._log_offset = self._log_signature[1]
+        self._own_unread = set()
+
+    def query_archive(self, collection: str, telegram_id: Optional[int] = None,
+                      date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[Dict]:
+        """Найти архивные диалоги или записи по telegram_id и периоду"""
+        if collection not in ARCHIVE_TELEGRAM_FIELDS:
+            raise ValueError(f"Коллекция не архивируется: {collection}")
+        return read_archive(self.archive_dir, collection, telegram_id, date_from, date_to)
+
+    @synchronized
+    def add_employee(self, employee_data: Dict) -> int:
+        """Добавить сотрудника"""
+        employee_id = self._next_id("employees")
+        employee_data["id"] = employee_id
+        employee_data["created_at"] = datetime.now().isoformat()
+        employee = MODELS["employees"].from_dict(employee_data)
+        self._data["employees"].append(employee)
+        self._index_record("employees", employee)
+        self._emit(change_event("employee_added", "employees", employee_id, employee))
+        self.save_data("employees")
+        return employee_id
+
+    @synchronized
+    def update_employee(self, employee_id: int, employee_data: Dict) -> bool:
+        """Обновить сотрудника"""
+        employee = self._by_id["employees"].get(employee_id)
+        if employee is None:
+            return False
+        self._update_record("employees", employee, employee_data)
+        self.save_data("employees")
+        return True
+
+    @synchronized
     def delete_employee(self, employee_id: int) -> bool:
         """Удалить сотрудника"""
-        for i, employee in enumerate(self.data.get("employees", [])):
-            if employee["id"] == employee_id:
-                del self.data["employees"][i]
-                self.save_data()
-                return True
-        return False
+        employee = self._by_id["employees"].get(employee_id)
+        if employee is None:
+            return False
+        self._remove_record("employees", employee)
+        self.save_data("employees")
+        return True
 
     # ===== AI prompts =====
     def get_ai_system_prompt(self) -> Optional[str]:
         try:
-            # всегда перечитываем файл, чтобы изменения из веб-панели применялись без перезапуска
-            self.data = self.load_data()
-            return (self.data.get("ai_prompts", {}) or {}).get("system_prompt")
+            # подхватываем изменения из веб-панели без перезапуска (перечитываем только при изменении файла)
+            self.reload()
+            return (self._data.get("ai_prompts", {}) or {}).get("system_prompt")
         except Exception:
             return None
 
+    @synchronized
     def set_ai_system_prompt(self, prompt_text: str):
-        if "ai_prompts" not in self.data or not isinstance(self.data["ai_prompts"], dict):
-            self.data["ai_prompts"] = {}
-        self.data["ai_prompts"]["system_prompt"] = prompt_text or None
-        self.save_data()
\ No newline at end of file
+        if "ai_prompts" not in self._data or not isinstance(self._data["ai_prompts"], dict):
+            self._data["ai_prompts"] = {}
+        self._data["ai_prompts"]["system_prompt"] = prompt_text or None
+        self._emit(change_event("prompt_updated", None, None, {"system_prompt": prompt_text or None}))
+        self.save_data("ai_prompts")
+
+
+def create_crm(database_url: Optional[str] = None, **options):
+    """Создать хранилище CRM по DATABASE_URL.
+
+    sqlite:///bonus_education.db — SQLite, json:///crm_data.json или пусто — JSON-файл.
+    options (write_behind и т.п.) относятся только к JSON-хранилищу.
+    Если DATABASE_URL не передан явно и задан CRM_SOCKET, возвращается клиент
+    общего сервиса CRM (crm_server.py), который владеет данными за всех.
+    """
+    if database_url is None and os.getenv("CRM_SOCKET"):
+        from crm_server import RemoteCRM
+        return RemoteCRM(os.getenv("CRM_SOCKET"))
+    url = database_url if database_url is not None else os.getenv("DATABASE_URL", "")
+    options.setdefault("compact", os.getenv("CRM_COMPACT_JSON", "").lower() in ("1", "true", "yes"))
+    if url.startswith("sqlite:///"):
+        from sqlite_crm import SQLiteCRM
+        return SQLiteCRM(url[len("sqlite:///"):])
+    if url.startswith("json:///"):
+        return SimpleCRM(url[len("json:///"):], **options)
+    return SimpleCRM(**options)
\ No newline at end of file
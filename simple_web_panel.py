@@ -3,49 +3,43 @@
 Современная веб-панель CRM для Bonus Education с красивым UI/UX
 """
 
-from fastapi import FastAPI, Request, Form, HTTPException, Depends, Response
+from fastapi import FastAPI, Request, Form, HTTPException, Depends, Response, Query
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from simple_crm import SimpleCRM
+from dotenv import load_dotenv
+from simple_crm import create_crm
+from crm_models import KANBAN_STATUSES, format_tashkent_datetime, normalize_booking_status, normalize_user_status, sort_ts, to_plain
 from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+import asyncio
 import json
+import logging
 import uvicorn
 import csv
 import io
 import os
 import hashlib
+import zlib
 import secrets
+from collections import deque
 from typing import Optional, List
 
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения (DATABASE_URL выбирает хранилище CRM)
+load_dotenv()
+
 app = FastAPI(title="Bonus Education CRM", version="2.0.0")
 
 # Настройка шаблонов
 templates = Jinja2Templates(directory="templates")
 
 # Фильтр форматирования времени под Ташкент (Asia/Tashkent)
-def format_tashkent_datetime(dt_str: str) -> str:
-    try:
-        if not dt_str:
-            return "—"
-        # Парсим ISO строку
-        dt = datetime.fromisoformat(dt_str)
-        tz = ZoneInfo("Asia/Tashkent")
-        # Если без таймзоны — считаем, что это время Ташкента
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=tz)
-        else:
-            dt = dt.astimezone(tz)
-        return dt.strftime("%d.%m.%Y %H:%M")
-    except Exception:
-        return dt_str or "—"
-
 templates.env.filters["tzdatetime"] = format_tashkent_datetime
 
 # CRM система
-crm = SimpleCRM()
+crm = create_crm()
 
 # Система авторизации
 security = HTTPBasic()
@@ -63,16 +57,15 @@ def verify_password(password: str, hashed: str) -> bool:
 
 def get_current_user(credentials: HTTPBasicCredentials = Depends(security)):
     """Получение текущего пользователя"""
-    employees = crm.get_all_employees()
-    for employee in employees:
-        if employee["username"] == credentials.username:
-            if verify_password(credentials.password, employee["password_hash"]):
-                if employee["is_active"]:
-                    return employee
-                else:
-                    raise HTTPException(status_code=401, detail="Аккаунт заблокирован")
+    employee = crm.get_employee_by_username(credentials.username)
+    if employee:
+        if verify_password(credentials.password, employee["password_hash"]):
+            if employee["is_active"]:
+                return employee
             else:
-                raise HTTPException(status_code=401, detail="Неверный пароль")
+                raise HTTPException(status_code=401, detail="Аккаунт заблокирован")
+        else:
+            raise HTTPException(status_code=401, detail="Неверный пароль")
     raise HTTPException(status_code=401, detail="Пользователь не найден")
 
 def check_permission(user, page: str) -> bool:
@@ -123,57 +116,31 @@ def require_auth(request: Request):
         raise HTTPException(status_code=401, detail="Необходима авторизация")
     return user
 
-# Нормализация статуса пользователя к единому набору (как на Kanban)
-def normalize_user_status(raw_status: str) -> str:
-    """Нормализуем статус пользователя к расширенной воронке Канбан"""
-    if not raw_status:
-        return "new"
-    s = str(raw_status).strip().lower()
-    allowed = {
-        "new", "call_success", "call_failed", "callback",
-        "trial_booking", "online_trial_booking", "trial_completed",
-        "prepayment", "waiting_group", "success", "failed"
-    }
-    legacy_map = {
-        "active": "call_success",
-        "converted": "success",
-        "pending": "new",
-        "inactive": "failed",
-        "won": "success",
-        "lost": "failed",
-        "in_progress": "call_success",
-    }
-    if s in allowed:
-        return s
-    return legacy_map.get(s, "new")
-
-# Нормализация статусов записей к набору Канбан
-def normalize_booking_status(raw_status: str) -> str:
-    """Приводит различные статусы бронирований к единому набору Канбан"""
-    if not raw_status:
-        return "new"
-    s = str(raw_status).strip().lower()
-    # Полный список столбцов в Kanban
-    allowed = {
-        "all", "new", "call_success", "call_failed", "callback",
-        "trial_booking", "online_trial_booking", "trial_completed",
-        "prepayment", "waiting_group", "success", "failed"
-    }
-    legacy_map = {
-        # Из прежнего списка таблицы
-        "pending": "new",
-        "confirmed": "success",
-        "cancelled": "failed",
-        # Возможные другие синонимы
-        "in_progress": "call_success",
-        "won": "success",
-        "lost": "failed",
-        "active": "call_success",
-        "inactive": "failed"
+# Размер страницы списков; больше MAX_PAGE_SIZE за раз не отдаём
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Сколько карточек показывать в колонке Канбан (остальные — в списке пользователей)
+KANBAN_COLUMN_LIMIT = 50
+
+def list_filters(status: Optional[str] = None, source: Optional[str] = None, q: Optional[str] = None,
+                 date_from: Optional[str] = None, date_to: Optional[str] = None, sort: Optional[str] = None,
+                 order: str = Query("desc", regex="^(asc|desc)$"), offset: int = Query(0, ge=0),
+                 limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)) -> dict:
+    """Фильтры и страница списка из строки запроса (пустые поля формы — без фильтра)"""
+    return {
+        "status": status or None, "source": source or None, "q": q or None,
+        "date_from": date_from or None, "date_to": date_to or None, "sort": sort or None,
+        "descending": order == "desc", "offset": offset, "limit": limit,
     }
-    if s in allowed:
-        return s
-    return legacy_map.get(s, "new")
+
+def query_list(query, filters: dict, default_sort: str) -> dict:
+    """Выполнить crm.query_users / crm.query_bookings; неверный фильтр — ошибка 400"""
+    params = {key: value for key, value in filters.items() if value is not None}
+    params.setdefault("sort", default_sort)
+    try:
+        return query(**params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # Страница входа
 @app.get("/login", response_class=HTMLResponse)
@@ -187,20 +154,19 @@ async def login(
     password: str = Form(...)
 ):
     """Обработка входа в систему"""
-    employees = crm.get_all_employees()
-    for employee in employees:
-        if employee["username"] == username:
-            if verify_password(password, employee["password_hash"]):
-                if employee["is_active"]:
-                    # Создаем сессию
-                    session_id = create_session(employee)
-                    response = RedirectResponse(url="/", status_code=303)
-                    response.set_cookie(key="session_id", value=session_id)
-                    return response
-                else:
-                    raise HTTPException(status_code=401, detail="Аккаунт заблокирован")
+    employee = crm.get_employee_by_username(username)
+    if employee:
+        if verify_password(password, employee["password_hash"]):
+            if employee["is_active"]:
+                # Создаем сессию
+                session_id = create_session(employee)
+                response = RedirectResponse(url="/", status_code=303)
+                response.set_cookie(key="session_id", value=session_id)
+                return response
             else:
-                raise HTTPException(status_code=401, detail="Неверный пароль")
+                raise HTTPException(status_code=401, detail="Аккаунт заблокирован")
+        else:
+            raise HTTPException(status_code=401, detail="Неверный пароль")
     raise HTTPException(status_code=401, detail="Пользователь не найден")
 
 @app.get("/logout")
@@ -228,7 +194,7 @@ async def dashboard(request: Request):
     user = require_auth(request)
     stats = crm.get_statistics()
     recent_bookings = crm.get_recent_bookings(10)
-    recent_conversations = crm.get_recent_conversations(5)
+    recent_conversations = crm.get_recent_conversations(limit=5)
     active_users = crm.get_users_by_activity(7)
     
     return templates.TemplateResponse("dashboard.html", {
@@ -242,54 +208,38 @@ async def dashboard(request: Request):
 
 # Страница пользователей
 @app.get("/users", response_class=HTMLResponse)
-async def users_page(request: Request):
-    """Страница управления пользователями"""
+async def users_page(request: Request, filters: dict = Depends(list_filters)):
+    """Страница управления пользователями (фильтры и страницы считает CRM)"""
     user = require_auth(request)
     # Обновляем данные CRM из файла, чтобы видеть свежие диалоги/пользователей
     try:
-        crm.data = crm.load_data()
+        crm.reload()
     except Exception:
         pass
-    users = crm.data["users"]
-    active_users = crm.get_users_by_activity(7)
+    page = query_list(crm.query_users, filters, "created_at")
     stats = crm.get_statistics()
 
-    # Подсчет метрик для каждого пользователя
-    conversations = crm.data.get("conversations", [])
-    bookings = crm.data.get("bookings", [])
-
     users_with_stats = []
-    new_users_today = 0
-    today_str = datetime.now().date().isoformat()
-    for u in users:
-        telegram_id = u.get("telegram_id")
-        user_conversations = [c for c in conversations if c.get("telegram_id") == telegram_id]
-        user_bookings = [b for b in bookings if b.get("user_id") == telegram_id]
-
-        unique_course_ids = set()
-        for b in user_bookings:
-            course_id = b.get("course_id")
-            if course_id is not None:
-                unique_course_ids.add(course_id)
-
+    for u in page["items"]:
+        # Метрики пользователя — счётчики по telegram_id, посчитанные в CRM
+        user_metrics = crm.get_user_metrics(u.get("telegram_id"))
         enriched = dict(u)
-        enriched["user_conversations_count"] = len(user_conversations)
-        enriched["user_bookings_count"] = len(user_bookings)
-        enriched["user_courses_count"] = len(unique_course_ids)
-        enriched["status"] = normalize_user_status(enriched.get("status"))
+        enriched["user_conversations_count"] = user_metrics["conversations_count"]
+        enriched["user_bookings_count"] = user_metrics["bookings_count"]
+        enriched["user_courses_count"] = user_metrics["courses_count"]
+        enriched["status"] = u.get("kanban_status") or normalize_user_status(u.get("status"))
         users_with_stats.append(enriched)
 
-        # Подсчет новых пользователей за сегодня
-        created_at = u.get("created_at")
-        if isinstance(created_at, str) and created_at[:10] == today_str:
-            new_users_today += 1
+    today = datetime.now().date().isoformat()
     return templates.TemplateResponse("users.html", {
         "request": request,
         "users": users_with_stats,
-        "active_users": active_users,
+        "page": page,
+        "active_users_count": len(crm.get_users_by_activity(7)),
+        "new_users_count": crm.query_users(status="new", limit=0)["total"],
         "current_user": user,
         "stats": stats,
-        "new_users_today": new_users_today
+        "new_users_today": crm.query_users(date_from=today, date_to=today, limit=0)["total"]
     })
 
 # Детали пользователя
@@ -298,61 +248,51 @@ async def user_detail_page(request: Request, user_id: int):
     current = require_auth(request)
     # Обновляем данные CRM из файла для актуальной истории чатов
     try:
-        crm.data = crm.load_data()
+        crm.reload()
     except Exception:
         pass
 
     # Находим пользователя по ID
-    target_user = None
-    for u in crm.data.get("users", []):
-        if u.get("id") == user_id:
-            target_user = dict(u)
-            target_user["status"] = normalize_user_status(target_user.get("status"))
-            break
-
+    target_user = crm.get_user_by_id(user_id)
     if not target_user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
+    target_user = dict(target_user)
+    target_user["status"] = target_user.get("kanban_status") or normalize_user_status(target_user.get("status"))
 
     # Считаем метрики пользователя
     telegram_id = target_user.get("telegram_id")
-    all_conversations = crm.data.get("conversations", [])
-    all_bookings = crm.data.get("bookings", [])
-
-    user_conversations = [c for c in all_conversations if c.get("telegram_id") == telegram_id]
-    user_bookings = [b for b in all_bookings if b.get("user_id") == telegram_id]
+    user_conversations = crm.get_user_conversations(telegram_id)
+    user_bookings = crm.get_user_bookings(telegram_id)
 
-    unique_course_ids = set()
-    for b in user_bookings:
-        course_id = b.get("course_id")
-        if course_id is not None:
-            unique_course_ids.add(course_id)
-
-    target_user["conversations_count"] = len(user_conversations)
-    target_user["bookings_count"] = len(user_bookings)
-    target_user["courses_count"] = len(unique_course_ids)
+    user_metrics = crm.get_user_metrics(telegram_id)
+    target_user["conversations_count"] = user_metrics["conversations_count"]
+    target_user["bookings_count"] = user_metrics["bookings_count"]
+    target_user["courses_count"] = user_metrics["courses_count"]
 
     # Формируем последние активности (до 10 шт.)
     recent_activities = []
     # Добавляем бронирования
-    for b in sorted(user_bookings, key=lambda x: x.get("created_at", ""), reverse=True)[:5]:
+    for b in sorted(user_bookings, key=lambda x: sort_ts(x, "created_at"), reverse=True)[:5]:
         recent_activities.append({
             "type": "booking",
             "description": f"Заявка на курс: {b.get('course_name', 'Не указан')}",
-            "date": b.get("created_at", "")
+            "date": b.get("created_at", ""),
+            "ts": sort_ts(b, "created_at")
         })
     # Добавляем диалоги
-    for c in sorted(user_conversations, key=lambda x: x.get("created_at", ""), reverse=True)[:5]:
+    for c in sorted(user_conversations, key=lambda x: sort_ts(x, "created_at"), reverse=True)[:5]:
         recent_activities.append({
             "type": "conversation",
             "description": f"Сообщение: {c.get('message', '')[:50]}",
-            "date": c.get("created_at", "")
+            "date": c.get("created_at", ""),
+            "ts": sort_ts(c, "created_at")
         })
 
     # Сортируем общий список по дате
-    recent_activities = sorted(recent_activities, key=lambda x: x.get("date", ""), reverse=True)[:10]
+    recent_activities = sorted(recent_activities, key=lambda x: x["ts"], reverse=True)[:10]
 
     # Список диалогов по времени (вся история)
-    conversations_sorted = sorted(user_conversations, key=lambda x: x.get("created_at", ""))
+    conversations_sorted = user_conversations
 
     return templates.TemplateResponse("user_detail.html", {
         "request": request,
@@ -362,28 +302,62 @@ async def user_detail_page(request: Request, user_id: int):
         "current_user": current
     })
 
-# API: получить диалоги пользователя (по ID пользователя CRM)
-@app.get("/api/user_conversations/{user_id}")
-async def api_user_conversations(user_id: int):
+# Длинный опрос чата: сколько максимум держать запрос
+LONG_POLL_MAX_WAIT = 30
+
+async def reload_in_thread():
+    """crm.reload() в пуле потоков: stat() файлов и перечитывание не блокируют цикл событий"""
     try:
-        crm.data = crm.load_data()
+        await asyncio.to_thread(crm.reload)
     except Exception:
         pass
 
+# API: получить диалоги пользователя (по ID пользователя CRM)
+@app.get("/api/user_conversations/{user_id}")
+async def api_user_conversations(request: Request, user_id: int, since_id: Optional[int] = None,
+                                 since_ts: Optional[str] = None,
+                                 wait: float = Query(0, ge=0, le=LONG_POLL_MAX_WAIT)):
+    """Диалоги по возрастанию времени; с since_id / since_ts — только новые.
+
+    wait > 0 — длинный опрос: ответ приходит, как только появится новое сообщение,
+    или через wait секунд пустым списком. Новые сообщения ждём по журналу изменений,
+    который опрашивает один общий ChangeBroadcaster, а не каждый запрос сам.
+    """
+    await reload_in_thread()
+
     # находим telegram_id по user_id
-    telegram_id = None
-    for u in crm.data.get("users", []):
-        if u.get("id") == user_id:
-            telegram_id = u.get("telegram_id")
-            break
+    user = crm.get_user_by_id(user_id)
+    telegram_id = user.get("telegram_id") if user else None
 
     if telegram_id is None:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
 
-    conversations = [c for c in crm.data.get("conversations", []) if c.get("telegram_id") == telegram_id]
-    # сортируем по времени по возрастанию, чтобы рендерить сверху-вниз, а потом скроллить вниз
-    conversations = sorted(conversations, key=lambda x: x.get("created_at", ""))
-    return conversations
+    def user_conversations():
+        try:
+            # по времени по возрастанию, чтобы рендерить сверху-вниз, а потом скроллить вниз
+            return crm.get_user_conversations(telegram_id, since_id=since_id, since_ts=since_ts)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if not wait:
+        return user_conversations()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    # Подписываемся до чтения: сообщение, записанное после reload(), разбудит ожидание
+    waiter = await broadcaster.watch_chat(telegram_id)
+    try:
+        while True:
+            waiter.clear()
+            await reload_in_thread()
+            conversations = user_conversations()
+            if conversations or loop.time() >= deadline or await request.is_disconnected():
+                return conversations
+            try:
+                await asyncio.wait_for(waiter.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        broadcaster.unwatch_chat(telegram_id, waiter)
 
 # Страница курсов
 @app.get("/courses", response_class=HTMLResponse)
@@ -406,44 +380,15 @@ async def teachers_page(request: Request):
     user = require_auth(request)
     # Перечитываем данные, чтобы подтянуть свежие изменения
     try:
-        crm.data = crm.load_data()
+        crm.reload()
     except Exception:
         pass
-    # Берем оригинальные данные и обогащаем полями для списка
-    raw_teachers = [t for t in crm.data.get("teachers", []) if t.get("is_active", True)]
-    enriched_teachers = []
-    from datetime import datetime
-    for t in raw_teachers:
-        # Опыт в годах: берем явный, иначе считаем по created_at
-        exp_years = t.get("experience_years")
-        try:
-            exp_years = int(exp_years) if exp_years is not None else None
-        except Exception:
-            exp_years = None
-        if exp_years is None:
-            created_at = t.get("created_at")
-            if created_at:
-                try:
-                    exp_years = max(0, datetime.now().year - datetime.fromisoformat(created_at).year)
-                except Exception:
-                    exp_years = None
-        # Нормализация языков в список
-        raw_langs = t.get("languages")
-        if isinstance(raw_langs, list):
-            langs = raw_langs
-        elif isinstance(raw_langs, str) and raw_langs.strip():
-            langs = [lng.strip() for lng in raw_langs.split(",") if lng.strip()]
-        else:
-            langs = []
-
-        enriched = dict(t)
-        enriched["experience_years_display"] = exp_years
-        enriched["languages"] = langs
-        enriched_teachers.append(enriched)
+    # Опыт в годах и список языков уже посчитаны при записи (crm_models.materialize)
+    teachers = [t for t in crm.get_all_teachers() if t.get("is_active", True)]
 
     return templates.TemplateResponse("teachers.html", {
         "request": request,
-        "teachers": enriched_teachers,
+        "teachers": teachers,
         "current_user": user
     })
 
@@ -452,49 +397,27 @@ async def teachers_page(request: Request):
 async def teacher_detail_page(request: Request, teacher_id: int):
     user = require_auth(request)
     # Берем оригинальные данные преподавателя из хранилища, а не нормализованные
-    teacher = next((t for t in crm.data.get('teachers', []) if t.get('id') == teacher_id), None)
+    teacher = crm.get_teacher(teacher_id)
     if not teacher:
         raise HTTPException(status_code=404, detail="Преподаватель не найден")
-    # Авто-расчет опыта по дате создания, если нет experience_years
-    exp_years = teacher.get('experience_years')
-    try:
-        exp_years = int(exp_years) if exp_years is not None else None
-    except Exception:
-        exp_years = None
-    if exp_years is None:
-        try:
-            created_at = next((t.get('created_at') for t in crm.data.get('teachers', []) if t.get('id') == teacher_id), None)
-            if created_at:
-                from datetime import datetime
-                years = datetime.now().year - datetime.fromisoformat(created_at).year
-                exp_years = years if years >= 0 else None
-        except Exception:
-            exp_years = None
     return templates.TemplateResponse("teacher_detail.html", {
         "request": request,
         "teacher": teacher,
-        "experience_years_display": exp_years,
+        "experience_years_display": teacher.get("experience_years_display"),
         "current_user": user
     })
 
 # Страница записей
 @app.get("/bookings", response_class=HTMLResponse)
-async def bookings_page(request: Request):
+async def bookings_page(request: Request, filters: dict = Depends(list_filters)):
     """Страница управления записями"""
     user = require_auth(request)
-    bookings = crm.get_recent_bookings(50)
-    # Добавляем форматированные даты по Ташкенту
-    enriched = []
-    for b in bookings:
-        item = dict(b)
-        item["created_at_fmt"] = format_tashkent_datetime(b.get("created_at"))
-        item["updated_at_fmt"] = format_tashkent_datetime(b.get("updated_at"))
-        # Приводим статус к единому набору для согласованности с Kanban
-        item["status"] = normalize_booking_status(b.get("status"))
-        enriched.append(item)
+    # Даты по Ташкенту и статус для Канбан хранятся в записи (crm_models.materialize)
+    page = query_list(crm.query_bookings, dict(filters, source=None), "created_at")
     return templates.TemplateResponse("bookings.html", {
         "request": request,
-        "bookings": enriched,
+        "bookings": page["items"],
+        "page": page,
         "current_user": user
     })
 
@@ -505,7 +428,7 @@ async def booking_detail_page(request: Request, booking_id: int):
     user = require_auth(request)
     # Перечитываем данные для актуальности
     try:
-        crm.data = crm.load_data()
+        crm.reload()
     except Exception:
         pass
     booking = crm.get_booking(booking_id)
@@ -513,11 +436,7 @@ async def booking_detail_page(request: Request, booking_id: int):
         raise HTTPException(status_code=404, detail="Запись не найдена")
 
     # Подтягиваем пользователя и курс/преподавателя при наличии
-    related_user = None
-    for u in crm.data.get("users", []):
-        if u.get("telegram_id") == booking.get("user_id"):
-            related_user = u
-            break
+    related_user = crm.get_user(booking.get("user_id")) if booking.get("user_id") is not None else None
 
     course = None
     if booking.get("course_id"):
@@ -525,16 +444,13 @@ async def booking_detail_page(request: Request, booking_id: int):
 
     teacher = None
     if booking.get("teacher_id"):
-        for t in crm.data.get("teachers", []):
-            if t.get("id") == booking.get("teacher_id"):
-                teacher = t
-                break
+        teacher = crm.get_teacher(booking.get("teacher_id"))
 
     return templates.TemplateResponse("booking_detail.html", {
         "request": request,
         "booking": booking,
-        "created_at_fmt": format_tashkent_datetime(booking.get("created_at")),
-        "updated_at_fmt": format_tashkent_datetime(booking.get("updated_at")),
+        "created_at_fmt": booking.get("created_at_fmt") or format_tashkent_datetime(booking.get("created_at")),
+        "updated_at_fmt": booking.get("updated_at_fmt") or format_tashkent_datetime(booking.get("updated_at")),
         "related_user": related_user,
         "course": course,
         "teacher": teacher,
@@ -584,23 +500,39 @@ async def kanban_page(request: Request):
     user = require_auth(request)
     # Перечитываем актуальные данные
     try:
-        crm.data = crm.load_data()
+        crm.reload()
     except Exception:
         pass
+    # В каждой колонке — самые недавно активные; итоги колонок считает CRM по индексу статусов
+    columns = {
+        status: crm.query_users(status=status, sort="last_activity", limit=KANBAN_COLUMN_LIMIT)
+        for status in KANBAN_STATUSES
+    }
+    column_totals = {status: page["total"] for status, page in columns.items()}
+    summary = {
+        "total": sum(column_totals.values()),
+        "success": column_totals["success"],
+        "failed": column_totals["failed"],
+    }
+    summary["process"] = summary["total"] - summary["success"] - summary["failed"] - column_totals["call_failed"]
     # Преобразуем пользователей в вид "bookings" для текущего шаблона
-    users_raw = crm.data.get("users", [])
+    users_raw = [u for page in columns.values() for u in page["items"]]
+    # Счётчики только для показанных карточек, одним вызовом
+    metrics = {m["telegram_id"]: m for m in crm.get_users_metrics([u.get("telegram_id") for u in users_raw])}
     bookings_like = []
     for u in users_raw:
-        status_raw = normalize_user_status(u.get("status"))
+        status_raw = u.get("kanban_status") or normalize_user_status(u.get("status"))
         # Используем статус как есть — колонки в шаблоне покрывают всю воронку
         mapped_status = status_raw
         full_name = ((u.get("first_name") or "").strip() + " " + (u.get("last_name") or "").strip()).strip()
         display_name = full_name or (u.get("username") or "Не указано")
         booking_card = {
             "id": u.get("id") or u.get("telegram_id"),
+            "telegram_id": u.get("telegram_id"),
             "user_name": display_name,
             "user_phone": u.get("phone") or "Не указан",
             "course_name": "—",
+            "bookings_count": metrics.get(u.get("telegram_id"), {}).get("bookings_count", 0),
             "status": mapped_status,
             "created_at": u.get("last_activity")
         }
@@ -608,6 +540,9 @@ async def kanban_page(request: Request):
     return templates.TemplateResponse("kanban.html", {
         "request": request,
         "bookings": bookings_like,
+        "column_totals": column_totals,
+        "column_limit": KANBAN_COLUMN_LIMIT,
+        "summary": summary,
         "current_user": user
     })
 
@@ -642,7 +577,6 @@ async def add_course(
 ):
     """API для добавления курса (расширенные поля)"""
     course = {
-        "id": len(crm.data["courses"]) + 1,
         "name": name,
         "description": description,
         "duration": duration or (f"{duration_months} месяца" if duration_months else None),
@@ -654,17 +588,14 @@ async def add_course(
         "days": [d for d in (days or []) if d],
         "time_from": time_from or None,
         "time_to": time_to or None,
-        "is_active": True,
-        "created_at": datetime.now().isoformat()
+        "is_active": True
     }
     if teacher_id:
-        for t in crm.data.get("teachers", []):
-            if t.get("id") == teacher_id:
-                course["teacher_id"] = teacher_id
-                course["teacher_name"] = t.get("name")
-                break
-    crm.data["courses"].append(course)
-    crm.save_data()
+        teacher = crm.get_teacher(teacher_id)
+        if teacher:
+            course["teacher_id"] = teacher_id
+            course["teacher_name"] = teacher.get("name")
+    crm.add_course(course)
     return {"success": True, "message": "Курс успешно добавлен"}
 
 @app.post("/add_teacher")
@@ -681,7 +612,6 @@ async def add_teacher(
 ):
     """Добавление преподавателя"""
     teacher = {
-        "id": len(crm.data["teachers"]) + 1,
         "name": name,
         "telegram_contact": telegram_contact,
         "certificate_level": certificate_level,
@@ -691,11 +621,9 @@ async def add_teacher(
         "work_time_end": work_time_end,
         "advantages": advantages,
         "disadvantages": disadvantages,
-        "is_active": True,
-        "created_at": datetime.now().isoformat()
+        "is_active": True
     }
-    crm.data["teachers"].append(teacher)
-    crm.save_data()
+    crm.add_teacher(teacher)
     return RedirectResponse(url="/teachers", status_code=303)
 
 # Маршруты для сотрудников
@@ -712,13 +640,10 @@ async def add_employee(
 ):
     """Добавление сотрудника"""
     # Проверяем уникальность логина
-    employees = crm.get_all_employees()
-    for emp in employees:
-        if emp["username"] == username:
-            raise HTTPException(status_code=400, detail="Пользователь с таким логином уже существует")
+    if crm.get_employee_by_username(username):
+        raise HTTPException(status_code=400, detail="Пользователь с таким логином уже существует")
     
     employee = {
-        "id": len(employees) + 1,
         "name": name,
         "role": role,
         "username": username,
@@ -726,11 +651,9 @@ async def add_employee(
         "email": email,
         "phone": phone,
         "permissions": permissions,
-        "is_active": is_active,
-        "created_at": datetime.now().isoformat()
+        "is_active": is_active
     }
-    crm.data["employees"].append(employee)
-    crm.save_data()
+    crm.add_employee(employee)
     return RedirectResponse(url="/employees", status_code=303)
 
 @app.post("/update_employee/{employee_id}")
@@ -745,27 +668,23 @@ async def update_employee(
     is_active: bool = Form(True)
 ):
     """Обновление сотрудника"""
-    employees = crm.get_all_employees()
-    for i, emp in enumerate(employees):
-        if emp["id"] == employee_id:
-            # Проверяем уникальность логина (кроме текущего пользователя)
-            for emp2 in employees:
-                if emp2["username"] == username and emp2["id"] != employee_id:
-                    raise HTTPException(status_code=400, detail="Пользователь с таким логином уже существует")
-            
-            employee_data = {
-                "name": name,
-                "role": role,
-                "username": username,
-                "email": email,
-                "phone": phone,
-                "permissions": permissions,
-                "is_active": is_active,
-                "updated_at": datetime.now().isoformat()
-            }
-            crm.data["employees"][i].update(employee_data)
-            crm.save_data()
-            return RedirectResponse(url="/employees", status_code=303)
+    # Проверяем уникальность логина (кроме текущего пользователя)
+    same_login = crm.get_employee_by_username(username)
+    if same_login and same_login["id"] != employee_id:
+        raise HTTPException(status_code=400, detail="Пользователь с таким логином уже существует")
+
+    employee_data = {
+        "name": name,
+        "role": role,
+        "username": username,
+        "email": email,
+        "phone": phone,
+        "permissions": permissions,
+        "is_active": is_active,
+        "updated_at": datetime.now().isoformat()
+    }
+    if crm.update_employee(employee_id, employee_data):
+        return RedirectResponse(url="/employees", status_code=303)
     
     raise HTTPException(status_code=404, detail="Сотрудник не найден")
 
@@ -782,9 +701,9 @@ async def get_stats(request: Request):
     return crm.get_statistics()
 
 @app.get("/api/users")
-async def get_users():
-    """API для получения пользователей"""
-    return crm.data["users"]
+async def get_users(filters: dict = Depends(list_filters)):
+    """API для получения пользователей: {"items", "total", "offset", "limit"}"""
+    return query_list(crm.query_users, filters, "created_at")
 
 @app.get("/api/courses")
 async def get_courses():
@@ -792,9 +711,9 @@ async def get_courses():
     return crm.get_courses()
 
 @app.get("/api/bookings")
-async def get_bookings():
-    """API для получения записей"""
-    return crm.get_recent_bookings(50)
+async def get_bookings(filters: dict = Depends(list_filters)):
+    """API для получения записей: {"items", "total", "offset", "limit"}"""
+    return query_list(crm.query_bookings, dict(filters, source=None), "created_at")
 
 @app.get("/api/analytics")
 async def get_analytics():
@@ -809,6 +728,153 @@ async def get_analytics():
         "active_users": active_users
     }
 
+# ===== Поток изменений для страниц (Server-Sent Events) =====
+# Журнал изменений CRM читается один раз на все открытые вкладки, браузерам уходят готовые дельты
+EVENTS_POLL_INTERVAL = 1.0
+EVENTS_KEEPALIVE = 15
+EVENTS_BACKLOG = 500
+EVENTS_QUEUE_SIZE = 1000
+# Типы событий, которые нужны страницам
+PUSHED_EVENT_TYPES = {
+    "user_added", "user_updated", "user_status_changed", "user_deleted",
+    "booking_added", "booking_updated", "booking_status_changed", "booking_deleted",
+    "conversation_added",
+}
+
+def sse_message(event_type: str, data, event_id: Optional[int] = None) -> str:
+    lines = [f"event: {event_type}", "data: " + json.dumps(data, ensure_ascii=False, default=to_plain)]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+    return "\n".join(lines) + "\n\n"
+
+def browser_delta(event: dict) -> dict:
+    """Событие журнала для страницы: статусы сразу в терминах колонок Канбан"""
+    delta = {"seq": event["seq"], "type": event["type"], "id": event.get("id"), "data": event.get("data") or {}}
+    if event["type"] == "user_status_changed":
+        delta["kanban_status"] = normalize_user_status(delta["data"].get("status"))
+        delta["old_kanban_status"] = normalize_user_status(delta["data"].get("old_status"))
+    elif event["type"] == "booking_status_changed":
+        delta["kanban_status"] = normalize_booking_status(delta["data"].get("status"))
+        delta["old_kanban_status"] = normalize_booking_status(delta["data"].get("old_status"))
+    return delta
+
+class ChangeBroadcaster:
+    """Опрашивает журнал изменений CRM, пока есть подключённые браузеры, и раздаёт им события.
+
+    Длинные опросы чата ждут здесь же новых диалогов своего пользователя.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        # telegram_id -> события asyncio, которые будятся при новом диалоге пользователя
+        self.chat_waiters = {}
+        # Последние события — для переподключения по Last-Event-ID без потерь
+        self.backlog = deque(maxlen=EVENTS_BACKLOG)
+        self.backlog_start = None
+        self.last_seq = None
+        self._task = None
+
+    async def _init_seq(self):
+        if self.last_seq is None:
+            self.last_seq = self.backlog_start = await asyncio.to_thread(crm.last_change_seq)
+
+    def _ensure_running(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def connect(self, last_event_id: Optional[int]) -> asyncio.Queue:
+        queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+        await self._init_seq()
+        if last_event_id is not None and last_event_id < self.last_seq:
+            if last_event_id >= self.backlog_start:
+                for seq, message in self.backlog:
+                    if seq > last_event_id:
+                        queue.put_nowait(message)
+            else:
+                # Пропущено больше, чем помним, — странице проще перезагрузиться
+                queue.put_nowait(sse_message("reset", {}, self.last_seq))
+        self.clients.add(queue)
+        self._ensure_running()
+        return queue
+
+    def disconnect(self, queue: asyncio.Queue):
+        self.clients.discard(queue)
+
+    async def watch_chat(self, telegram_id: int) -> asyncio.Event:
+        """Событие, которое взводится при каждом новом диалоге пользователя"""
+        await self._init_seq()
+        waiter = asyncio.Event()
+        self.chat_waiters.setdefault(telegram_id, set()).add(waiter)
+        self._ensure_running()
+        return waiter
+
+    def unwatch_chat(self, telegram_id: int, waiter: asyncio.Event):
+        waiters = self.chat_waiters.get(telegram_id, set())
+        waiters.discard(waiter)
+        if not waiters:
+            self.chat_waiters.pop(telegram_id, None)
+
+    def _broadcast(self, message: str):
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Браузер не успевает читать — отключаем, он переподключится с Last-Event-ID
+                self.clients.discard(queue)
+
+    async def _run(self):
+        try:
+            while self.clients or self.chat_waiters:
+                try:
+                    events = await asyncio.to_thread(crm.read_changes, self.last_seq, EVENTS_QUEUE_SIZE)
+                    pushed = False
+                    for event in events:
+                        self.last_seq = event["seq"]
+                        if event.get("type") == "conversation_added":
+                            for waiter in self.chat_waiters.get((event.get("data") or {}).get("telegram_id"), ()):
+                                waiter.set()
+                        if event.get("type") not in PUSHED_EVENT_TYPES:
+                            continue
+                        message = sse_message(event["type"], browser_delta(event), event["seq"])
+                        if len(self.backlog) == self.backlog.maxlen:
+                            self.backlog_start = self.backlog[0][0]
+                        self.backlog.append((event["seq"], message))
+                        self._broadcast(message)
+                        pushed = True
+                    if pushed and self.clients:
+                        # Счётчики после пачки изменений — одним сообщением
+                        self._broadcast(sse_message("stats", await asyncio.to_thread(crm.get_statistics)))
+                except Exception:
+                    logger.exception("Ошибка чтения журнала изменений CRM")
+                await asyncio.sleep(EVENTS_POLL_INTERVAL)
+        finally:
+            self._task = None
+
+broadcaster = ChangeBroadcaster()
+
+@app.get("/api/events")
+async def events_stream(request: Request):
+    """Поток изменений CRM (SSE): новые лиды, смена статусов, новые записи, счётчики"""
+    require_auth(request)
+    last_event_id = request.headers.get("last-event-id", "")
+    queue = await broadcaster.connect(int(last_event_id) if last_event_id.isdigit() else None)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            # Отключённый за отставание клиент дочитывает очередь и переподключается
+            while queue in broadcaster.clients or not queue.empty():
+                try:
+                    yield await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Комментарий-пинг: прокси не закрывают соединение, а разрыв обнаруживается
+                    yield ": ping\n\n"
+        finally:
+            broadcaster.disconnect(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/update_booking_status/{booking_id}", response_class=RedirectResponse)
 async def update_booking_status(
     booking_id: int,
@@ -850,11 +916,10 @@ async def edit_course(course_id: int, request: Request):
     if teacher_id_raw:
         try:
             teacher_id = int(teacher_id_raw)
-            for t in crm.data.get("teachers", []):
-                if t.get("id") == teacher_id:
-                    course_data["teacher_id"] = teacher_id
-                    course_data["teacher_name"] = t.get("name")
-                    break
+            teacher = crm.get_teacher(teacher_id)
+            if teacher:
+                course_data["teacher_id"] = teacher_id
+                course_data["teacher_name"] = teacher.get("name")
         except ValueError:
             pass
     crm.update_course(course_id, course_data)
@@ -960,12 +1025,10 @@ async def update_booking_status(booking_id: int, status: str = Form(...)):
         if updated:
             return JSONResponse({"success": True, "message": "Статус записи обновлен"})
         # Пытаемся обновить пользователя, если запись не найдена
-        for i, u in enumerate(crm.data.get("users", [])):
-            if u.get("id") == booking_id or u.get("telegram_id") == booking_id:
-                crm.data["users"][i]["status"] = status
-                crm.data["users"][i]["updated_at"] = datetime.now().isoformat()
-                crm.save_data()
-                return JSONResponse({"success": True, "message": "Статус пользователя обновлен"})
+        u = crm.get_user_by_id(booking_id) or crm.get_user(booking_id)
+        if u:
+            crm.update_user(u["id"], {"status": status, "updated_at": datetime.now().isoformat()})
+            return JSONResponse({"success": True, "message": "Статус пользователя обновлен"})
         return JSONResponse({"success": False, "message": "Ни запись, ни пользователь не найдены"}, status_code=404)
     except Exception as e:
         return JSONResponse({"success": False, "message": str(e)}, status_code=400)
@@ -975,66 +1038,92 @@ async def update_booking_status(booking_id: int, status: str = Form(...)):
 async def update_user_status(user_id: int, status: str = Form(...)):
     try:
         # Находим пользователя по CRM id (telegram_id хранится как user_id в заявках)
-        for i, u in enumerate(crm.data.get("users", [])):
-            if u.get("id") == user_id or u.get("telegram_id") == user_id:
-                crm.data["users"][i]["status"] = status
-                crm.data["users"][i]["updated_at"] = datetime.now().isoformat()
-                crm.save_data()
-                return JSONResponse({"success": True, "message": "Статус пользователя обновлен"})
+        u = crm.get_user_by_id(user_id) or crm.get_user(user_id)
+        if u:
+            crm.update_user(u["id"], {"status": status, "updated_at": datetime.now().isoformat()})
+            return JSONResponse({"success": True, "message": "Статус пользователя обновлен"})
         return JSONResponse({"success": False, "message": "Пользователь не найден"}, status_code=404)
     except Exception as e:
         return JSONResponse({"success": False, "message": str(e)}, status_code=400)
 
 # Маршруты для экспорта в CSV
-@app.get("/export/{data_type}")
-async def export_to_csv(data_type: str):
-    """Экспорт данных в CSV"""
-    try:
-        if data_type == "users":
-            data = crm.get_all_users()
-            filename = f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            
-        elif data_type == "bookings":
-            data = crm.get_all_bookings()
-            filename = f"bookings_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            
-        elif data_type == "courses":
-            data = crm.get_all_courses()
-            filename = f"courses_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            
-        elif data_type == "teachers":
-            data = crm.get_all_teachers()
-            filename = f"teachers_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            
-        else:
-            raise HTTPException(status_code=400, detail="Неверный тип данных")
-        
-        if not data:
-            raise HTTPException(status_code=404, detail="Данные не найдены")
-        
-        # Создаем CSV файл в памяти
-        output = io.StringIO()
-        if data:
-            fieldnames = data[0].keys()
-            writer = csv.DictWriter(output, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(data)
-        
+# Выгрузка: коллекции, размер куска при чтении из CRM и типы ответа
+EXPORT_COLLECTIONS = ("users", "bookings", "courses", "teachers")
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+def iter_export_chunks(collection: str):
+    """Коллекция кусками по EXPORT_CHUNK_SIZE записей"""
+    offset = 0
+    while True:
+        chunk = crm.get_records_chunk(collection, offset, EXPORT_CHUNK_SIZE)
+        if chunk:
+            yield chunk
+        if len(chunk) < EXPORT_CHUNK_SIZE:
+            return
+        offset += len(chunk)
+
+def csv_value(value):
+    """Значение ячейки CSV: списки и словари — в JSON"""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=to_plain)
+    return value
+
+def export_lines(collection: str, export_format: str):
+    """Текст выгрузки по кускам: память не зависит от размера коллекции"""
+    if export_format == "ndjson":
+        for chunk in iter_export_chunks(collection):
+            yield "".join(json.dumps(record, ensure_ascii=False, default=to_plain) + "\n" for record in chunk)
+        return
+
+    # Заголовок CSV — объединение ключей всех записей (первый проход читает только ключи)
+    fieldnames = {}
+    for chunk in iter_export_chunks(collection):
+        for record in chunk:
+            fieldnames.update(dict.fromkeys(record))
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(fieldnames), restval="", extrasaction="ignore")
+    writer.writeheader()
+    for chunk in iter_export_chunks(collection):
+        for record in chunk:
+            writer.writerow({key: csv_value(value) for key, value in record.items()})
+        yield output.getvalue()
         output.seek(0)
-        csv_content = output.getvalue()
-        
-        # Конвертируем в bytes для FileResponse
-        csv_bytes = io.BytesIO(csv_content.encode('utf-8'))
-        csv_bytes.seek(0)
-        
-        return FileResponse(
-            path=csv_bytes,
-            filename=filename,
-            media_type='text/csv'
-        )
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка экспорта: {str(e)}")
+        output.truncate()
+    if output.tell():
+        yield output.getvalue()
+
+def encode_stream(lines, compress: bool):
+    """str -> bytes, при compress — поток gzip"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 — формат gzip
+    for text in lines:
+        data = text.encode("utf-8")
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+@app.get("/export/{data_type}")
+async def export_data(data_type: str, format: str = Query("csv", regex="^(csv|ndjson)$"), compress: bool = False):
+    """Потоковая выгрузка коллекции в CSV или NDJSON (compress=1 — в gzip)"""
+    if data_type not in EXPORT_COLLECTIONS:
+        raise HTTPException(status_code=400, detail="Неверный тип данных")
+    if not crm.get_records_chunk(data_type, 0, 1):
+        raise HTTPException(status_code=404, detail="Данные не найдены")
+
+    filename = f"{data_type}_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    media_type = EXPORT_MEDIA_TYPES[format]
+    if compress:
+        filename += ".gz"
+        media_type = "application/gzip"
+    # Синхронный генератор Starlette обходит в пуле потоков — цикл событий не блокируется
+    return StreamingResponse(
+        encode_stream(export_lines(data_type, format), compress),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 if __name__ == "__main__":
     print("🌐 Запуск современной веб-панели Bonus Education...")
@@ -0,0 +1,701 @@
+#!/usr/bin/env python3
+"""
+CRM на SQLite с тем же интерфейсом, что и SimpleCRM
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional
+
+from crm_models import DISPLAY_FIELDS_VERSION, materialize
+from simple_crm import (
+    SimpleCRM, normalize_course, normalize_teacher, statistics_view, change_event, update_event,
+    QUERY_SORT_KEYS, QUERY_TEXT_FIELDS, QUERY_TELEGRAM_FIELDS, query_date_range, query_page,
+    CHANGE_ENTITIES, CHANGES_KEEP_DAYS, ARCHIVE_AFTER_DAYS, ARCHIVE_TELEGRAM_FIELDS, CLOSED_BOOKING_STATUSES, append_archive, read_archive,
+)
+
+logger = logging.getLogger(__name__)
+
+# Колонки, вынесенные из JSON-записи для индексов и фильтров
+TABLES = {
+    "users": ("telegram_id", "status", "kanban_status", "source", "created_at", "last_activity"),
+    "bookings": ("user_id", "course_id", "status", "kanban_status", "created_at"),
+    "conversations": ("telegram_id", "created_at"),
+    "courses": ("is_active",),
+    "teachers": ("is_active",),
+    "employees": ("username", "is_active"),
+}
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_status ON users(status)",
+    "CREATE INDEX IF NOT EXISTS idx_users_kanban_status ON users(kanban_status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_user_id ON bookings(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_created_at ON bookings(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_status ON bookings(status)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_kanban_status ON bookings(kanban_status, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_telegram_id ON conversations(telegram_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_employees_username ON employees(username)",
+]
+
+
+class SQLiteCRM:
+    def __init__(self, db_file: str = "bonus_education.db", import_from: str = "crm_data.json"):
+        self.db_file = db_file
+        self.archive_dir = os.path.splitext(db_file)[0] + ".archive"
+        # Одно соединение на процесс; доступ из разных потоков сериализуем блокировкой
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._tx_failed = False
+        # События изменений, записанные в текущей транзакции, и подписчики в этом процессе
+        self._pending_events = []
+        self._subscribers = []
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.create_function("casefold", 1, lambda value: value.casefold() if isinstance(value, str) else value,
+                                   deterministic=True)
+        self._create_schema()
+        self._import_if_empty(import_from)
+        self._materialize_existing()
+
+    def _create_schema(self):
+        """Создать таблицы и индексы"""
+        with self._write() as conn:
+            for table, columns in TABLES.items():
+                extra = "".join(f", {column}" for column in columns)
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY{extra}, data TEXT NOT NULL)")
+                # Колонки, добавленные после создания базы
+                existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for column in columns:
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # Последние выданные id: после удаления записи её id не выдаётся повторно
+            conn.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # Журнал изменений: seq растёт вместе с транзакциями, которые их записали
+            conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)")
+            for statement in INDEXES:
+                conn.execute(statement)
+
+    def _import_if_empty(self, json_file: str):
+        """Один раз перенести данные из JSON-хранилища (или тестовые данные) в пустую базу"""
+        with self._write() as conn:
+            if conn.execute("SELECT COUNT(*) FROM settings").fetchone()[0]:
+                return
+            # Только чтение: выбор SQLite не должен переписывать JSON-хранилище
+            data = SimpleCRM(json_file, read_only=True).data
+            for table in TABLES:
+                seen = set()
+                for record in data.get(table, []):
+                    record = dict(record)
+                    if record.get("id") in seen:
+                        # Старые версии выдавали повторяющиеся id — не затираем запись, а даём новый
+                        record["id"] = None
+                    record["id"] = self._insert(conn, table, record)
+                    seen.add(record["id"])
+            for key in ("ai_prompts", "schedule", "analytics"):
+                self._set_setting(conn, key, data.get(key, {} if key == "ai_prompts" else []))
+
+    def _materialize_existing(self):
+        """Один раз дописать поля для отображения (и их колонки) в записи, созданные до их появления"""
+        with self._write() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = 'display_fields'").fetchone()
+            if row and json.loads(row[0]) >= DISPLAY_FIELDS_VERSION:
+                return
+            for table in ("users", "bookings", "teachers"):
+                assignments = ", ".join(f"{column} = ?" for column in TABLES[table])
+                for record_id, data in conn.execute(f"SELECT id, data FROM {table}").fetchall():
+                    record = json.loads(data)
+                    materialize(table, record)
+                    values = self._row_values(table, record) + [json.dumps(record, ensure_ascii=False), record_id]
+                    conn.execute(f"UPDATE {table} SET {assignments}, data = ? WHERE id = ?", values)
+            self._set_setting(conn, "display_fields", DISPLAY_FIELDS_VERSION)
+
+    @contextmanager
+    def _write(self):
+        """Транзакция записи (BEGIN IMMEDIATE сразу берет блокировку записи в файле)"""
+        with self._lock:
+            if self._tx_depth:
+                # Внутри transaction() изменения входят во внешнюю транзакцию
+                yield self._conn
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                self._pending_events = []
+                raise
+            self._conn.execute("COMMIT")
+            self._notify()
+
+    # ===== Транзакции (как в SimpleCRM) =====
+    def begin(self):
+        """Начать транзакцию; вложенная транзакция становится частью внешней"""
+        self._lock.acquire()
+        if not self._tx_depth:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+            except BaseException:
+                self._lock.release()
+                raise
+            self._tx_failed = False
+        self._tx_depth += 1
+
+    def commit(self):
+        if not self._tx_depth:
+            raise RuntimeError("Транзакция не начата")
+        try:
+            self._tx_depth -= 1
+            if self._tx_depth:
+                return
+            if self._tx_failed:
+                self._conn.execute("ROLLBACK")
+                self._pending_events = []
+                raise RuntimeError("Транзакция отменена: во вложенном блоке был rollback()")
+            self._conn.execute("COMMIT")
+            self._notify()
+        finally:
+            self._lock.release()
+
+    def rollback(self):
+        if not self._tx_depth:
+            raise RuntimeError("Транзакция не начата")
+        try:
+            self._tx_depth -= 1
+            if self._tx_depth:
+                self._tx_failed = True
+                return
+            self._conn.execute("ROLLBACK")
+            self._pending_events = []
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def transaction(self):
+        """Группа изменений в одной транзакции SQLite"""
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    batch = transaction
+
+    # ===== Журнал изменений (как в SimpleCRM) =====
+    def subscribe(self, callback):
+        """Подписаться на изменения: callback(event) вызывается после фиксации транзакции"""
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def read_changes(self, since_seq: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        """События журнала изменений с seq > since_seq по возрастанию seq"""
+        sql = "SELECT seq, data FROM changes WHERE seq > ? ORDER BY seq"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._conn.execute(sql, (since_seq,)).fetchall()
+        return [{"seq": seq, **json.loads(data)} for seq, data in rows]
+
+    def last_change_seq(self) -> int:
+        """seq последнего события в журнале изменений"""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def _log_change(self, conn, event: Dict):
+        seq = conn.execute("INSERT INTO changes (data) VALUES (?)", (json.dumps(event, ensure_ascii=False),)).lastrowid
+        self._pending_events.append({"seq": seq, **event})
+
+    def _notify(self):
+        events, self._pending_events = self._pending_events, []
+        for event in events:
+            for callback in list(self._subscribers):
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception("Ошибка в подписчике на изменения CRM")
+
+    # ===== Общие операции над таблицами =====
+    def _row_values(self, table: str, record: Dict) -> List:
+        values = []
+        for column in TABLES[table]:
+            if column == "is_active":
+                values.append(bool(record.get("is_active", True)))
+            else:
+                values.append(record.get(column))
+        return values
+
+    def _insert(self, conn, table: str, record: Dict) -> int:
+        if record.get("id") is None:
+            record["id"] = self._next_id(conn, table)
+        materialize(table, record)
+        columns = ("id",) + TABLES[table] + ("data",)
+        placeholders = ", ".join("?" for _ in columns)
+        values = [record["id"]] + self._row_values(table, record) + [json.dumps(record, ensure_ascii=False)]
+        conn.execute(f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", values)
+        return record["id"]
+
+    def _next_id(self, conn, table: str) -> int:
+        row = conn.execute("SELECT value FROM sequences WHERE name = ?", (table,)).fetchone()
+        # MAX(id) по первичному ключу — O(log n); учитывает записи, вставленные с явным id
+        top = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        next_id = max(row[0] if row else 0, top) + 1
+        conn.execute("INSERT OR REPLACE INTO sequences (name, value) VALUES (?, ?)", (table, next_id))
+        return next_id
+
+    def _add(self, table: str, record: Dict) -> int:
+        with self._write() as conn:
+            record_id = self._insert(conn, table, record)
+            self._log_change(conn, change_event(f"{CHANGE_ENTITIES[table]}_added", table, record_id, record))
+            return record_id
+
+    def _update(self, table: str, record_id: int, changes: Dict, event: Optional[Dict] = None,
+                log_change: bool = True) -> bool:
+        with self._write() as conn:
+            row = conn.execute(f"SELECT data FROM {table} WHERE id = ?", (record_id,)).fetchone()
+            if not row:
+                return False
+            record = json.loads(row[0])
+            old_status = record.get("status")
+            record.update(changes)
+            materialize(table, record)
+            assignments = ", ".join(f"{column} = ?" for column in TABLES[table])
+            values = self._row_values(table, record) + [json.dumps(record, ensure_ascii=False), record_id]
+            conn.execute(f"UPDATE {table} SET {assignments}, data = ? WHERE id = ?", values)
+            if log_change:
+                self._log_change(conn, event or update_event(table, record_id, old_status, changes))
+            return True
+
+    def _delete(self, table: str, record_id: int) -> bool:
+        with self._write() as conn:
+            if not conn.execute(f"DELETE FROM {table} WHERE id = ?", (record_id,)).rowcount:
+                return False
+            self._log_change(conn, change_event(f"{CHANGE_ENTITIES[table]}_deleted", table, record_id))
+            return True
+
+    def _select(self, table: str, where: str = "", params: tuple = (), order: str = "id",
+                limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        sql = f"SELECT data FROM {table}"
+        if where:
+            sql += f" WHERE {where}"
+        sql += f" ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+            if offset:
+                sql += f" OFFSET {int(offset)}"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _select_one(self, table: str, where: str, params: tuple) -> Optional[Dict]:
+        rows = self._select(table, where, params, limit=1)
+        return rows[0] if rows else None
+
+    def _count(self, table: str, where: str = "", params: tuple = ()) -> int:
+        sql = f"SELECT COUNT(*) FROM {table}" + (f" WHERE {where}" if where else "")
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    def _group_count(self, table: str, column: str) -> Dict:
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {column}, COUNT(*) FROM {table} GROUP BY {column}").fetchall()
+        return {(value or "unknown"): count for value, count in rows}
+
+    def _get_setting(self, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_setting(self, conn, key: str, value):
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def reload(self):
+        """Совместимость с SimpleCRM: данные и так всегда читаются из базы"""
+
+    def flush(self):
+        """Совместимость с SimpleCRM: каждая операция фиксируется сразу"""
+
+    def close(self):
+        """Закрыть соединение с базой"""
+        with self._lock:
+            self._conn.close()
+
+    # ===== Пользователи =====
+    def add_user(self, user_data: Dict) -> int:
+        """Добавить пользователя"""
+        user_data.pop("id", None)
+        user_data["created_at"] = datetime.now().isoformat()
+        user_data["last_activity"] = datetime.now().isoformat()
+        return self._add("users", user_data)
+
+    def get_user(self, telegram_id: int) -> Optional[Dict]:
+        """Получить пользователя по Telegram ID"""
+        return self._select_one("users", "telegram_id = ?", (telegram_id,))
+
+    def get_user_by_id(self, user_id: int) -> Optional[Dict]:
+        """Получить пользователя по ID в CRM"""
+        return self._select_one("users", "id = ?", (user_id,))
+
+    def update_user_activity(self, telegram_id: int):
+        """Обновить активность пользователя"""
+        user = self.get_user(telegram_id)
+        if user:
+            # В журнал изменений не пишется: событие на каждое сообщение бота никому не нужно
+            self._update("users", user["id"], {"last_activity": datetime.now().isoformat()}, log_change=False)
+
+    def update_user(self, user_id: int, user_data: Dict) -> bool:
+        """Обновить пользователя"""
+        return self._update("users", user_id, user_data)
+
+    def delete_user(self, user_id: int) -> bool:
+        """Удалить пользователя"""
+        return self._delete("users", user_id)
+
+    def get_all_users(self):
+        """Получить всех пользователей"""
+        return self._select("users")
+
+    def get_users_by_activity(self, days: int = 7) -> List[Dict]:
+        """Получить активных пользователей за последние N дней"""
+        cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
+        return self._select("users", "last_activity > ?", (cutoff_date,), order="last_activity DESC")
+
+    def query_users(self, status: Optional[str] = None, source: Optional[str] = None,
+                    date_from: Optional[str] = None, date_to: Optional[str] = None, q: Optional[str] = None,
+                    sort: str = "created_at", descending: bool = True, offset: int = 0, limit: int = 50) -> Dict:
+        """Страница пользователей: {"items", "total", "offset", "limit"} (фильтры как в SimpleCRM)"""
+        return self._query("users", status, source, date_from, date_to, q, sort, descending, offset, limit)
+
+    def _query(self, table: str, status, source, date_from, date_to, q, sort: str,
+               descending: bool, offset: int, limit: int) -> Dict:
+        if sort not in QUERY_SORT_KEYS[table]:
+            raise ValueError(f"Сортировка по {sort} не поддерживается")
+        offset, limit = max(offset, 0), max(limit, 0)
+        lower, upper = query_date_range(date_from, date_to)
+        where, params = [], []
+        if status:
+            where.append("kanban_status = ?")
+            params.append(status)
+        if source:
+            where.append("COALESCE(source, 'unknown') = ?")
+            params.append(source)
+        if lower:
+            where.append("created_at >= ?")
+            params.append(lower)
+        if upper:
+            where.append("created_at < ?")
+            params.append(upper)
+        if q and q.strip():
+            needle = q.strip()
+            # lower() и LIKE в SQLite не знают кириллицы — регистр снимает casefold() из Python
+            matches = [f"{QUERY_TELEGRAM_FIELDS[table]} = ?"]
+            params.append(int(needle) if needle.isdigit() else needle)
+            for field in QUERY_TEXT_FIELDS[table]:
+                matches.append(f"instr(casefold(json_extract(data, '$.{field}')), ?) > 0")
+                params.append(needle.casefold())
+            where.append("(" + " OR ".join(matches) + ")")
+        where_sql = " AND ".join(where)
+        direction = "DESC" if descending else "ASC"
+        order = f"{sort} {direction}" + (f", id {direction}" if sort != "id" else "")
+        items = self._select(table, where_sql, tuple(params), order=order, limit=limit, offset=offset)
+        return query_page(items, self._count(table, where_sql, tuple(params)), offset, limit)
+
+    # ===== Диалоги =====
+    def add_conversation(self, telegram_id: int, message: str, response: str):
+        """Добавить диалог"""
+        conversation = {
+            "telegram_id": telegram_id,
+            "message": message,
+            "response": response,
+            "created_at": datetime.now().isoformat()
+        }
+        with self._write() as conn:
+            conversation_id = self._insert(conn, "conversations", conversation)
+            self._log_change(conn, change_event("conversation_added", "conversations", conversation_id,
+                                                {"telegram_id": telegram_id}))
+
+    def get_recent_conversations(self, user_id: int = None, limit: int = 10) -> List[Dict]:
+        """Получить последние диалоги"""
+        if user_id:
+            return self._select("conversations", "telegram_id = ?", (user_id,), order="created_at DESC", limit=limit)
+        return self._select("conversations", order="created_at DESC", limit=limit)
+
+    def get_user_metrics(self, telegram_id: int) -> Dict:
+        """Число диалогов, записей и разных курсов пользователя"""
+        with self._lock:
+            bookings, courses = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT course_id) FROM bookings WHERE user_id = ?", (telegram_id,)).fetchone()
+        return {
+            "telegram_id": telegram_id,
+            "conversations_count": self._count("conversations", "telegram_id = ?", (telegram_id,)),
+            "bookings_count": bookings,
+            "courses_count": courses,
+        }
+
+    def get_users_metrics(self, telegram_ids: List[int]) -> List[Dict]:
+        """get_user_metrics для списка пользователей: два GROUP BY по индексам вместо запросов на каждого"""
+        metrics = {telegram_id: {"telegram_id": telegram_id, "conversations_count": 0,
+                                 "bookings_count": 0, "courses_count": 0}
+                   for telegram_id in telegram_ids}
+        ids = list(metrics)
+        with self._lock:
+            # Кусками: у SQLite ограничено число параметров в запросе
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                marks = ", ".join("?" for _ in chunk)
+                for telegram_id, count in self._conn.execute(
+                        f"SELECT telegram_id, COUNT(*) FROM conversations WHERE telegram_id IN ({marks}) "
+                        f"GROUP BY telegram_id", chunk):
+                    metrics[telegram_id]["conversations_count"] = count
+                for telegram_id, count, courses in self._conn.execute(
+                        f"SELECT user_id, COUNT(*), COUNT(DISTINCT course_id) FROM bookings WHERE user_id IN ({marks}) "
+                        f"GROUP BY user_id", chunk):
+                    metrics[telegram_id]["bookings_count"] = count
+                    metrics[telegram_id]["courses_count"] = courses
+        return list(metrics.values())
+
+    def get_all_user_metrics(self) -> List[Dict]:
+        """get_user_metrics для всех, у кого есть диалоги или записи (два GROUP BY)"""
+        metrics = {}
+        with self._lock:
+            conversations = self._conn.execute(
+                "SELECT telegram_id, COUNT(*) FROM conversations GROUP BY telegram_id").fetchall()
+            bookings = self._conn.execute(
+                "SELECT user_id, COUNT(*), COUNT(DISTINCT course_id) FROM bookings GROUP BY user_id").fetchall()
+        for telegram_id, count in conversations:
+            metrics[telegram_id] = {"telegram_id": telegram_id, "conversations_count": count,
+                                    "bookings_count": 0, "courses_count": 0}
+        for telegram_id, count, courses in bookings:
+            entry = metrics.setdefault(telegram_id, {"telegram_id": telegram_id, "conversations_count": 0})
+            entry["bookings_count"] = count
+            entry["courses_count"] = courses
+        return list(metrics.values())
+
+    def get_user_conversations(self, telegram_id: int, since_id: Optional[int] = None,
+                               since_ts: Optional[str] = None) -> List[Dict]:
+        """Получить переписку пользователя по времени (по возрастанию); since_id / since_ts — только новее курсора"""
+        where, params = ["telegram_id = ?"], [telegram_id]
+        if since_id is not None:
+            where.append("id > ?")
+            params.append(since_id)
+        if since_ts:
+            try:
+                params.append(datetime.fromisoformat(since_ts).isoformat())
+            except ValueError:
+                raise ValueError(f"Неверная дата: {since_ts}")
+            where.append("created_at > ?")
+        return self._select("conversations", " AND ".join(where), tuple(params), order="created_at")
+
+    def get_all_conversations(self):
+        """Получить все диалоги"""
+        return self._select("conversations")
+
+    def get_records_chunk(self, collection: str, offset: int = 0, limit: int = 1000) -> List[Dict]:
+        """Часть таблицы по порядку id — выгрузка читает таблицу кусками"""
+        if collection not in TABLES:
+            raise ValueError(f"Неизвестная коллекция: {collection}")
+        return self._select(collection, order="id", limit=max(limit, 0), offset=max(offset, 0))
+
+    # ===== Архив =====
+    def archive(self, max_age_days: int = ARCHIVE_AFTER_DAYS) -> Dict:
+        """Перенести диалоги и закрытые записи старше max_age_days в архив,
+        удалить из журнала изменений события старше CHANGES_KEEP_DAYS"""
+        if self._tx_depth:
+            raise RuntimeError("Архивация внутри транзакции не поддерживается")
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+        statuses = sorted(CLOSED_BOOKING_STATUSES)
+        closed = f"LOWER(status) IN ({', '.join('?' for _ in statuses)})"
+        selections = {
+            "conversations": ("created_at < ?", (cutoff,)),
+            "bookings": (f"created_at < ? AND {closed}", (cutoff, *statuses)),
+        }
+        counts = {}
+        with self._write() as conn:
+            for table, (where, params) in selections.items():
+                rows = conn.execute(f"SELECT data FROM {table} WHERE {where}", params).fetchall()
+                counts[table] = len(rows)
+                if rows:
+                    # Архив дописывается до удаления: при сбое транзакция откатится, а дубли отсеет чтение
+                    append_archive(self.archive_dir, table, [json.loads(row[0]) for row in rows])
+                    conn.execute(f"DELETE FROM {table} WHERE {where}", params)
+            if any(counts.values()):
+                self._log_change(conn, change_event("archived", None, None, counts))
+            # Последнее событие остаётся: AUTOINCREMENT и так не повторит seq, но last_change_seq() не обнулится
+            keep_after = (datetime.now() - timedelta(days=CHANGES_KEEP_DAYS)).isoformat()
+            counts["changes"] = conn.execute(
+                "DELETE FROM changes WHERE json_extract(data, '$.ts') < ? AND seq < (SELECT MAX(seq) FROM changes)",
+                (keep_after,)).rowcount
+        return counts
+
+    def query_archive(self, collection: str, telegram_id: Optional[int] = None,
+                      date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[Dict]:
+        """Найти архивные диалоги или записи по telegram_id и периоду"""
+        if collection not in ARCHIVE_TELEGRAM_FIELDS:
+            raise ValueError(f"Коллекция не архивируется: {collection}")
+        return read_archive(self.archive_dir, collection, telegram_id, date_from, date_to)
+
+    # ===== Записи на курсы =====
+    def add_booking(self, booking_data: Dict) -> int:
+        """Добавить запись на курс"""
+        booking_data.pop("id", None)
+        booking_data["created_at"] = datetime.now().isoformat()
+        booking_data["status"] = "pending"
+        return self._add("bookings", booking_data)
+
+    def get_booking(self, booking_id: int) -> Optional[Dict]:
+        """Получить запись по ID"""
+        return self._select_one("bookings", "id = ?", (booking_id,))
+
+    def update_booking(self, booking_id: int, booking_data: Dict) -> bool:
+        """Обновить запись"""
+        return self._update("bookings", booking_id, booking_data)
+
+    def update_booking_status(self, booking_id: int, status: str) -> bool:
+        """Обновить статус записи"""
+        return self._update("bookings", booking_id, {"status": status, "updated_at": datetime.now().isoformat()})
+
+    def delete_booking(self, booking_id: int) -> bool:
+        """Удалить запись"""
+        return self._delete("bookings", booking_id)
+
+    def get_recent_bookings(self, limit: int = 10) -> List[Dict]:
+        """Получить последние записи"""
+        return self._select("bookings", order="created_at DESC", limit=limit)
+
+    def query_bookings(self, status: Optional[str] = None, date_from: Optional[str] = None,
+                       date_to: Optional[str] = None, q: Optional[str] = None, sort: str = "created_at",
+                       descending: bool = True, offset: int = 0, limit: int = 50) -> Dict:
+        """Страница записей на курсы, фильтры как у query_users"""
+        return self._query("bookings", status, None, date_from, date_to, q, sort, descending, offset, limit)
+
+    def get_user_bookings(self, telegram_id: int) -> List[Dict]:
+        """Получить заявки пользователя (user_id в заявке — это telegram_id)"""
+        return self._select("bookings", "user_id = ?", (telegram_id,))
+
+    def get_all_bookings(self):
+        """Получить все записи"""
+        return self._select("bookings")
+
+    # ===== Курсы =====
+    def get_courses(self) -> List[Dict]:
+        """Получить все курсы"""
+        return [normalize_course(course) for course in self._select("courses", "is_active")]
+
+    def get_course(self, course_id: int) -> Optional[Dict]:
+        """Получить курс по ID"""
+        course = self._select_one("courses", "id = ?", (course_id,))
+        return normalize_course(course) if course else None
+
+    def add_course(self, course_data: Dict) -> int:
+        """Добавить курс"""
+        course_data.pop("id", None)
+        course_data.setdefault("is_active", True)
+        course_data["created_at"] = datetime.now().isoformat()
+        return self._add("courses", course_data)
+
+    def update_course(self, course_id: int, course_data: Dict) -> bool:
+        """Обновить курс"""
+        if "days" in course_data and course_data["days"] is None:
+            course_data = dict(course_data, days=[])
+        return self._update("courses", course_id, course_data)
+
+    def delete_course(self, course_id: int) -> bool:
+        """Удалить курс"""
+        return self._delete("courses", course_id)
+
+    def get_all_courses(self):
+        """Получить все курсы"""
+        return self._select("courses")
+
+    # ===== Преподаватели =====
+    def get_teachers(self) -> List[Dict]:
+        """Получить всех преподавателей"""
+        return [normalize_teacher(teacher) for teacher in self._select("teachers", "is_active")]
+
+    def get_teacher(self, teacher_id: int) -> Optional[Dict]:
+        """Получить преподавателя по ID (исходная запись, без нормализации)"""
+        return self._select_one("teachers", "id = ?", (teacher_id,))
+
+    def add_teacher(self, teacher_data: Dict) -> int:
+        """Добавить преподавателя"""
+        teacher_data.pop("id", None)
+        teacher_data.setdefault("is_active", True)
+        teacher_data["created_at"] = datetime.now().isoformat()
+        return self._add("teachers", teacher_data)
+
+    def update_teacher(self, teacher_id: int, teacher_data: Dict) -> bool:
+        """Обновить преподавателя"""
+        return self._update("teachers", teacher_id, teacher_data)
+
+    def delete_teacher(self, teacher_id: int) -> bool:
+        """Удалить преподавателя"""
+        return self._delete("teachers", teacher_id)
+
+    def get_all_teachers(self):
+        """Получить всех преподавателей"""
+        return self._select("teachers")
+
+    # ===== Сотрудники =====
+    def get_all_employees(self):
+        """Получить всех сотрудников"""
+        return self._select("employees")
+
+    def get_employee_by_username(self, username: str) -> Optional[Dict]:
+        """Получить сотрудника по логину"""
+        return self._select_one("employees", "username = ?", (username,))
+
+    def add_employee(self, employee_data: Dict) -> int:
+        """Добавить сотрудника"""
+        employee_data.pop("id", None)
+        employee_data["created_at"] = datetime.now().isoformat()
+        return self._add("employees", employee_data)
+
+    def update_employee(self, employee_id: int, employee_data: Dict) -> bool:
+        """Обновить сотрудника"""
+        return self._update("employees", employee_id, employee_data)
+
+    def delete_employee(self, employee_id: int) -> bool:
+        """Удалить сотрудника"""
+        return self._delete("employees", employee_id)
+
+    # ===== Статистика =====
+    def get_statistics(self) -> Dict:
+        """Получить статистику"""
+        return statistics_view({
+            "total_users": self._count("users"),
+            "total_conversations": self._count("conversations"),
+            "total_bookings": self._count("bookings"),
+            "total_courses": self._count("courses"),
+            "active_courses": self._count("courses", "is_active"),
+            "total_teachers": self._count("teachers"),
+            "active_teachers": self._count("teachers", "is_active"),
+            "total_employees": self._count("employees"),
+            "bookings_by_status": self._group_count("bookings", "status"),
+            "users_by_source": self._group_count("users", "source"),
+        })
+
+    # ===== AI prompts =====
+    def get_ai_system_prompt(self) -> Optional[str]:
+        return (self._get_setting("ai_prompts", {}) or {}).get("system_prompt")
+
+    def set_ai_system_prompt(self, prompt_text: str):
+        with self._write() as conn:
+            prompts = self._get_setting("ai_prompts", {}) or {}
+            prompts["system_prompt"] = prompt_text or None
+            self._set_setting(conn, "ai_prompts", prompts)
+            self._log_change(conn, change_event("prompt_updated", None, None, {"system_prompt": prompt_text or None}))
@@ -18,6 +18,17 @@ fi
 echo "✅ Конфигурация найдена"
 echo "🚀 Запуск системы..."
 
+# Запускаем сервис CRM: единственный процесс, который владеет данными и пишет их на диск
+echo "🗄 Запуск сервиса CRM..."
+export CRM_SOCKET="$(pwd)/crm.sock"
+python3 crm_server.py "$CRM_SOCKET" &
+CRM_PID=$!
+# Ждем, пока сервис откроет сокет
+for _ in $(seq 1 50); do
+    [ -S "$CRM_SOCKET" ] && break
+    sleep 0.1
+done
+
 # Запускаем веб-панель в фоне
 echo "🌐 Запуск веб-панели..."
 python3 simple_web_panel.py &
@@ -49,7 +60,8 @@ echo ""
 echo "Для остановки нажмите Ctrl+C"
 
 # Обработка сигнала остановки
-trap "echo '🛑 Остановка системы...'; kill $WEB_PID $BOT_PID; exit" INT
+# Сервис CRM останавливаем последним — он сбрасывает данные на диск
+trap "echo '🛑 Остановка системы...'; kill $WEB_PID $BOT_PID; wait $WEB_PID $BOT_PID 2>/dev/null; kill $CRM_PID; wait $CRM_PID; exit" INT
 
 # Ждем завершения
 wait
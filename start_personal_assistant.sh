@@ -35,6 +35,17 @@ fi
 
 echo "✅ Все зависимости установлены"
 
+# Запускаем сервис CRM: единственный процесс, который владеет данными и пишет их на диск
+echo "🗄 Запуск сервиса CRM..."
+export CRM_SOCKET="$(pwd)/crm.sock"
+python3 crm_server.py "$CRM_SOCKET" &
+CRM_PID=$!
+# Ждем, пока сервис откроет сокет
+for _ in $(seq 1 50); do
+    [ -S "$CRM_SOCKET" ] && break
+    sleep 0.1
+done
+
 # Запускаем веб-панель в фоне
 echo "🌐 Запуск веб-панели..."
 python3 simple_web_panel.py &
@@ -56,7 +67,8 @@ echo "📱 Ваш аккаунт будет автоматически отве
 echo "🛑 Для остановки нажмите Ctrl+C"
 
 # Обработка сигнала остановки
-trap "echo '🛑 Остановка системы...'; kill $WEB_PID $BOT_PID 2>/dev/null; exit" INT
+# Сервис CRM останавливаем последним — он сбрасывает данные на диск
+trap "echo '🛑 Остановка системы...'; kill $WEB_PID $BOT_PID 2>/dev/null; wait $WEB_PID $BOT_PID 2>/dev/null; kill $CRM_PID 2>/dev/null; wait $CRM_PID; exit" INT
 
 # Ждем завершения
 wait